@@ -0,0 +1,484 @@
+#!/usr/bin/python
+
+# Copyright 2016 Vegard Knutsen Lillevoll
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times each stage of toadmin.txt on generated todo.txt files of different sizes, without any terminal
+# interaction. Results are written as JSON, and can be compared with the results of an earlier run.
+
+import os,sys,io,gc,json,time,random,datetime,tempfile,argparse,platform,contextlib,tracemalloc,importlib.util,shutil
+import habitica_server
+
+parser = argparse.ArgumentParser(description="Benchmark toadmin.txt on generated todo.txt files")
+parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated numbers of tasks")
+parser.add_argument("--stages", help="Comma-separated stages to run, default all")
+parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the fastest is reported")
+parser.add_argument("--output", help="File to write results to as JSON")
+parser.add_argument("--compare", help="Results of an earlier run to compare with")
+parser.add_argument("--generate", help="Only write a generated todo.txt with the first size to this file")
+parser.add_argument("--workers", default="1,2,4," + str(os.cpu_count() or 1),
+        help="Comma-separated numbers of worker processes for the load_parallel stage")
+parser.add_argument("--memory", action="store_true", help="Also measure memory used per task, loaded and parsed")
+parser.add_argument("--check", action="store_true",
+        help="Only check that the parser gives the results in parse_corpus.json, instead of timing anything")
+
+# Load toadmin.txt.py from next to this file. Its name isn't a valid module name, so it can't be imported directly.
+def load_toadmin():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "toadmin.txt.py")
+    spec = importlib.util.spec_from_file_location("toadmin", path)
+    module = importlib.util.module_from_spec(spec)
+    # Worker processes find the module's functions by name
+    sys.modules["toadmin"] = module
+    spec.loader.exec_module(module)
+    return module
+
+toadmin = load_toadmin()
+
+# Stand-in Habitica server for the sync stages, started when first used
+habitica = None
+
+words = ["call", "write", "fix", "review", "plan", "buy", "read", "email", "clean", "book", "report", "bug", "mail",
+        "meeting", "invoice", "tickets", "draft", "notes", "slides", "budget"]
+states = ["next", "today", "scheduled", "waiting", "someday", "new"]
+
+# Lines of a todo.txt with n tasks. Most tasks are done, like in a list that has been used for a while, the rest
+# are spread over the states, with priorities, projects, contexts and due dates.
+def generate_todotxt(n, seed = 0):
+    rng = random.Random(seed)
+    start = datetime.date(2015, 1, 1)
+    lines = []
+
+    def date():
+        return (start + datetime.timedelta(days = rng.randint(0, 4000))).isoformat()
+
+    for i in range(n):
+        text = " ".join(rng.choice(words) for w in range(rng.randint(2, 6)))
+        tags = ["+project" + str(int(rng.paretovariate(1.2)) % 200) for t in range(rng.randint(0, 2))]
+        tags += ["@context" + str(rng.randint(0, 15)) for t in range(rng.randint(0, 1))]
+
+        if rng.random() < 0.7:
+            created = date()
+            line = "x " + max(created, date()) + " " + created + " " + text
+            tags.append("state:done")
+
+        else:
+            line = rng.choice(["", "", "(A) ", "(B) ", "(C) "]) + date() + " " + text
+            state = rng.choice(states)
+            tags.append("state:" + state)
+            if state in ["scheduled", "waiting"] or rng.random() < 0.1:
+                tags.append("due:" + date())
+
+        rng.shuffle(tags)
+        lines.append(" ".join([line] + tags) + "\n")
+
+    return lines
+
+# Set up toadmin's globals for a todo.txt at path, as main() would
+def setup(path):
+    toadmin.options = {"todo.txt-location": path, "filter-color": False}
+    toadmin.data_file = path + ".options"
+    toadmin.todo_file = toadmin.TodoFile(path)
+    toadmin.todo_files = [toadmin.todo_file]
+    toadmin.snapshot_cache = None
+
+def load(path):
+    setup(path)
+    return toadmin.todo_file.load(workers = 1)
+
+def parsed(path):
+    todos = load(path)
+    for todo in todos:
+        todo.parse()
+    return todos
+
+def indexed(path):
+    todos = toadmin.TodoList(toadmin.do_auto_actions(load(path)))
+    toadmin.todo_file.listeners.append(todos)
+    return (todos, toadmin.TodoIndex(todos))
+
+# Each stage is (prepare, run): prepare(path) is not timed and returns what run gets. run returns the number of
+# items it handled.
+
+def stage_load(path):
+    return len(load(path))
+
+# Loading and parsing everything the automatic actions would parse, in one process or in a pool of workers
+def stage_load_parsed(path):
+    todos = load(path)
+    for todo in todos:
+        if not todo.parsed and not toadmin.done_line_settled(todo.raw):
+            todo.parse()
+    return len(todos)
+
+# With one worker this is load_parsed, the same work without a pool
+def load_parallel_stage(workers):
+    def stage(path):
+        if workers == 1:
+            return stage_load_parsed(path)
+
+        setup(path)
+        return len(toadmin.todo_file.load(workers = workers))
+    return stage
+
+# The same tasks split over a workspace of four files, loaded by load_todos in threads
+def prepare_workspace(path):
+    lines = open(path).readlines()
+    paths = []
+    for i in range(4):
+        paths.append(path + "." + str(i))
+        with open(paths[-1], "w") as part_file:
+            part_file.writelines(lines[i::4])
+    return paths
+
+def stage_load_workspace(paths):
+    setup(paths[0])
+    toadmin.todo_files = [toadmin.todo_file] + [toadmin.TodoFile(p) for p in paths[1:]]
+    return len(toadmin.load_todos())
+
+def prepare_localtodo(path):
+    return open(path).readlines()
+
+def stage_localtodo(lines):
+    for line in lines:
+        toadmin.LocalTodo(line).parse()
+    return len(lines)
+
+def prepare_parse_todotext(path):
+    return [t.text for t in parsed(path)]
+
+def stage_parse_todotext(texts):
+    for text in texts:
+        toadmin.parse_todotext(" " + text)
+    return len(texts)
+
+def stage_do_auto_actions(todos):
+    toadmin.do_auto_actions(todos)
+    return len(todos)
+
+def stage_get_interactive_task_list(prepared):
+    (todos, index) = prepared
+    (s, index_list) = toadmin.get_interactive_task_list(index, [])
+    return len(index_list)
+
+def prepare_promote(path):
+    (todos, index) = indexed(path)
+    return toadmin.DueScheduler(todos)
+
+# Promotes the tasks due in the first half of the generated dates
+def stage_promote(scheduler):
+    return len(scheduler.promote(datetime.date(2020, 6, 1)))
+
+def prepare_filter_match(path):
+    todos = [t for t in parsed(path) if not t.done]
+    return (todos, ["+project1"])
+
+def stage_filter_match(prepared):
+    (todos, filter) = prepared
+    for todo in todos:
+        toadmin.filter_match(todo, filter)
+    return len(todos)
+
+def prepare_filter_query(path):
+    (todos, index) = indexed(path)
+    return (index, ["+project1 and (state:next or state:today) and not pri:C", "due:2016-01-01..2020-12-31"])
+
+def stage_filter_query(prepared):
+    (index, queries) = prepared
+    for query in queries:
+        toadmin.compile_query(query, datetime.date.today()).tasks(index)
+    return len(queries)
+
+def stage_str_sort(todos):
+    todos.sort(key = lambda x: str(x))
+    return len(todos)
+
+def prepare_load_snapshot(path):
+    cache = toadmin.SnapshotCache(path + ".cache")
+    setup(path)
+    todos = toadmin.do_auto_actions(toadmin.todo_file.load(cache))
+    toadmin.todo_file.save(todos)
+    toadmin.todo_file.save_snapshot(cache, todos)
+    return (path, toadmin.SnapshotCache(path + ".cache"))
+
+def stage_load_snapshot(prepared):
+    (path, cache) = prepared
+    setup(path)
+    items = len(toadmin.todo_file.load(cache))
+    os.unlink(cache.path)
+    return items
+
+def stage_summary(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        toadmin.print_summary([path])
+    return sum(1 for line in open(path))
+
+def prepare_save_todos(path):
+    todos = parsed(path)
+    for todo in todos:
+        todo.touch()
+    return todos
+
+def stage_save_todos(todos):
+    toadmin.todo_file.save(todos)
+    return len(todos)
+
+def prepare_save_one(path):
+    (todos, index) = indexed(path)
+    next(t for t in todos if not t.done).priority = "(A) "
+    return todos
+
+def prepare_save_journal(path):
+    (todos, index) = indexed(path)
+    toadmin.todo_file.journal = toadmin.Journal(toadmin.journal_path(path))
+    next(t for t in todos if not t.done).priority = "(A) "
+    return todos
+
+def stage_save_journal(todos):
+    toadmin.todo_file.save(todos)
+    toadmin.todo_file.journal.clear()
+    return len(todos)
+
+# The columns --report builds in one pass, and the aggregates of them
+def stage_report(path):
+    columns = toadmin.TaskColumns()
+    with open(path) as todo_file:
+        columns.add_lines(todo_file)
+    toadmin.report_values(columns, datetime.date(2020, 6, 1))
+    return len(columns)
+
+# Every open task made recurring, some scheduled ahead like their next instances would be
+def make_recurring(path):
+    recurrences = ["1d", "1w", "+1w", "2w", "1m", "+1m", "3m", "+1y"]
+    lines = []
+    for (i, line) in enumerate(open(path)):
+        if not toadmin.line_is_done(line):
+            line = line.rstrip("\n") + " rec:" + recurrences[i % len(recurrences)] + "\n"
+        lines.append(line)
+
+    with open(path, "w") as todo_file:
+        todo_file.writelines(lines)
+    return path
+
+# What a start does with the tasks: loading, automatic actions, indexing and promoting those due. With
+# load_recurring, every open task recurs, and should take the same time per task as without.
+def stage_load_start(path):
+    todos = toadmin.TodoList(toadmin.do_auto_actions(load(path)))
+    toadmin.TodoIndex(todos)
+    toadmin.DueScheduler(todos).promote(datetime.date(2020, 6, 1))
+    return len(todos)
+
+# Marking 1000 recurring tasks done, each getting its next instance
+def prepare_complete_recurring(path):
+    (todos, index) = indexed(make_recurring(path))
+    toadmin.local_todos = todos
+    return [t for t in todos if not t.done][:1000]
+
+def stage_complete_recurring(todos):
+    for todo in todos:
+        toadmin.recur_todo(todo)
+        todo.done = True
+    return len(todos)
+
+# Syncing every task with Habitica, and syncing again after one change
+def prepare_habitica_sync(path):
+    global habitica
+    if habitica is None:
+        habitica = habitica_server.start()
+
+    (todos, index) = indexed(path)
+    toadmin.options.update({"habitica-user": "benchmark", "habitica-key": "benchmark", "habitica-url": habitica[1]})
+    return todos
+
+def stage_habitica_sync(todos):
+    (ok, out) = toadmin.sync_habitica(todos)
+    return len(todos)
+
+def prepare_habitica_sync_one(path):
+    todos = prepare_habitica_sync(path)
+    toadmin.sync_habitica(todos)
+    next(t for t in todos if not t.done).priority = "(A) "
+    return todos
+
+stages = [
+    ("load", lambda path: path, stage_load),
+    ("load_parsed", lambda path: path, stage_load_parsed),
+    ("load_workspace", prepare_workspace, stage_load_workspace),
+    ("LocalTodo", prepare_localtodo, stage_localtodo),
+    ("parse_todotext", prepare_parse_todotext, stage_parse_todotext),
+    ("load_from_snapshot", prepare_load_snapshot, stage_load_snapshot),
+    ("summary", lambda path: path, stage_summary),
+    ("do_auto_actions", load, stage_do_auto_actions),
+    ("promote", prepare_promote, stage_promote),
+    ("get_interactive_task_list", indexed, stage_get_interactive_task_list),
+    ("filter_match", prepare_filter_match, stage_filter_match),
+    ("filter_query", prepare_filter_query, stage_filter_query),
+    ("str_sort", parsed, stage_str_sort),
+    ("save_todos", prepare_save_todos, stage_save_todos),
+    ("save_todos_one_change", prepare_save_one, stage_save_todos),
+    ("save_journal_one_change", prepare_save_journal, stage_save_journal),
+    ("report", lambda path: path, stage_report),
+    ("load_start", lambda path: path, stage_load_start),
+    ("load_recurring", make_recurring, stage_load_start),
+    ("complete_recurring", prepare_complete_recurring, stage_complete_recurring),
+    ("habitica_sync", prepare_habitica_sync, stage_habitica_sync),
+    ("habitica_sync_one_change", prepare_habitica_sync_one, stage_habitica_sync),
+]
+
+def run(sizes, names, repeat):
+    results = []
+    directory = tempfile.mkdtemp(prefix = "toadmin-benchmark-")
+
+    for size in sizes:
+        path = os.path.join(directory, "todo-" + str(size) + ".txt")
+        lines = generate_todotxt(size)
+
+        for (name, prepare, stage) in stages:
+            if names and name not in names:
+                continue
+
+            best = None
+            for i in range(repeat):
+                # Every run starts from the generated file
+                with open(path, "w") as todo_file:
+                    todo_file.writelines(lines)
+
+                prepared = prepare(path)
+                start = time.perf_counter()
+                items = stage(prepared)
+                seconds = time.perf_counter() - start
+
+                if best is None or seconds < best:
+                    best = seconds
+
+            results.append({"stage": name, "size": size, "items": items, "seconds": best,
+                    "items_per_second": items / best if best else None})
+            print("%-28s %8d tasks %10.4f s %12.0f items/s" % (name, size, best, items / best if best else 0))
+
+        os.unlink(path)
+
+    shutil.rmtree(directory)
+    return results
+
+# Bytes of memory held per task after loading a todo.txt with size tasks, and after parsing all of them
+def measure_memory(size):
+    directory = tempfile.mkdtemp(prefix = "toadmin-benchmark-")
+    path = os.path.join(directory, "todo-" + str(size) + ".txt")
+    with open(path, "w") as todo_file:
+        todo_file.writelines(generate_todotxt(size))
+
+    results = []
+    setup(path)
+    gc.collect()
+    tracemalloc.start()
+
+    todos = toadmin.todo_file.load()
+    loaded = tracemalloc.get_traced_memory()[0]
+    for todo in todos:
+        todo.parse()
+    parsed = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    del todos
+    os.unlink(path)
+    os.rmdir(directory)
+
+    for (name, used) in [("memory_loaded", loaded), ("memory_parsed", parsed)]:
+        results.append({"stage": name, "size": size, "bytes_per_task": used / size})
+        print("%-28s %8d tasks %10.0f bytes/task" % (name, size, used / size))
+
+    return results
+
+# Print how much slower or faster each result is than the same stage and size in an earlier run
+def compare(results, earlier):
+    before = {(r["stage"], r["size"]): r["seconds"] for r in earlier["results"] if "seconds" in r}
+
+    print("\nCompared with " + earlier.get("created", "earlier run") + ":")
+    for r in results:
+        key = (r["stage"], r["size"])
+        if key in before and before[key] and "seconds" in r:
+            print("%-28s %8d tasks %8.2fx" % (r["stage"], r["size"], r["seconds"] / before[key]))
+
+# Lines of the corpus with the fields the original parser gave for each, or the exception it raised. A faster
+# parser has to give the same.
+corpus_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_corpus.json")
+
+def parse_fields(line):
+    def value(v):
+        if isinstance(v, datetime.date):
+            return v.isoformat()
+        return v
+
+    todo = toadmin.LocalTodo(line)
+    try:
+        todo.parse()
+    except Exception as e:
+        return {"error": type(e).__name__}
+
+    return {"done": todo.done, "priority": todo.priority, "created": value(todo.created),
+            "completed": value(todo.completed), "text": todo.text, "projects": list(todo.projects),
+            "contexts": list(todo.contexts), "addons": [[k, value(v)] for (k, v) in todo.addons.items()]}
+
+# Print the lines parsed differently from the corpus, and return how many there were
+def check(path):
+    with open(path) as corpus:
+        entries = json.load(corpus)
+
+    failed = 0
+    for entry in entries:
+        fields = parse_fields(entry["line"])
+        if fields != entry["expected"]:
+            failed += 1
+            print(repr(entry["line"]) + "\n  expected " + json.dumps(entry["expected"]) + "\n  got      " +
+                    json.dumps(fields))
+
+    print(str(len(entries) - failed) + " of " + str(len(entries)) + " lines parsed as expected")
+    return failed
+
+def main():
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    if args.check:
+        sys.exit(1 if check(corpus_file) else 0)
+
+    if args.generate:
+        with open(args.generate, "w") as todo_file:
+            todo_file.writelines(generate_todotxt(sizes[0]))
+        return
+
+    names = None
+    if args.stages:
+        names = args.stages.split(",")
+
+    for workers in sorted(set(int(w) for w in args.workers.split(","))):
+        stages.append(("load_parallel_" + str(workers), lambda path: path, load_parallel_stage(workers)))
+
+    results = run(sizes, names, args.repeat)
+    if args.memory:
+        for size in sizes:
+            results += measure_memory(size)
+    report = {"created": datetime.datetime.now().isoformat(timespec = "seconds"), "python": platform.python_version(),
+            "machine": platform.machine(), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent = 1)
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            compare(results, json.load(compare_file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# Copyright 2016 Vegard Knutsen Lillevoll
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for the parts of the Habitica API that toadmin.txt syncs with, keeping tasks in memory. For trying out
+# sync without a Habitica account, and for benchmarks. Sync with it by running "sync http://localhost:PORT".
+
+import json,uuid,time,argparse,threading,http.server
+
+parser = argparse.ArgumentParser(description="Serve a stand-in Habitica API for toadmin.txt to sync with")
+parser.add_argument("--port", type=int, default=8123, help="Port to listen on")
+parser.add_argument("--delay", type=float, default=0, help="Seconds to wait before answering, like a remote server")
+
+class HabiticaHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests, like Habitica does
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, data = None, message = None):
+        reply = {"success": status < 400}
+        if data is not None:
+            reply["data"] = data
+        if message is not None:
+            reply["message"] = message
+
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Check the request and return its path below /api/v3 and its body, or None when it was answered already
+    def begin(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = None
+        if length:
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if not self.headers.get("x-api-user") or not self.headers.get("x-api-key"):
+            self.answer(401, message = "Missing authentication headers")
+            return None
+
+        if not self.path.startswith("/api/v3/"):
+            self.answer(404, message = "Not found")
+            return None
+
+        return (self.path[len("/api/v3"):], body)
+
+    def do_GET(self):
+        request = self.begin()
+        if request is None:
+            return
+
+        if request[0] == "/tasks/user":
+            with self.server.lock:
+                self.answer(200, list(self.server.tasks.values()))
+
+        else:
+            self.answer(404, message = "Not found")
+
+    def do_POST(self):
+        request = self.begin()
+        if request is None:
+            return
+
+        (path, body) = request
+        parts = path.split("/")
+
+        # Create one task, or a list of them
+        if path == "/tasks/user":
+            created = []
+            with self.server.lock:
+                for task in (body if isinstance(body, list) else [body]):
+                    task = dict(task, id = str(uuid.uuid4()))
+                    self.server.tasks[task["id"]] = task
+                    created.append(task)
+
+            self.answer(201, created if isinstance(body, list) else created[0])
+
+        # /tasks/ID/score/up or down
+        elif len(parts) == 5 and parts[1] == "tasks" and parts[3] == "score" and parts[4] in ["up", "down"]:
+            with self.server.lock:
+                task = self.server.tasks.get(parts[2])
+                if task is not None:
+                    task["completed"] = parts[4] == "up"
+
+            if task is None:
+                self.answer(404, message = "Task not found")
+            else:
+                self.answer(200, {"delta": 1})
+
+        else:
+            self.answer(404, message = "Not found")
+
+    def do_PUT(self):
+        request = self.begin()
+        if request is None:
+            return
+
+        (path, body) = request
+        parts = path.split("/")
+        if len(parts) != 3 or parts[1] != "tasks":
+            self.answer(404, message = "Not found")
+            return
+
+        # Like Habitica, completing a task only happens by scoring it
+        with self.server.lock:
+            task = self.server.tasks.get(parts[2])
+            if task is not None:
+                task.update({k: v for (k, v) in body.items() if k not in ["id", "completed"]})
+                task = dict(task)
+
+        if task is None:
+            self.answer(404, message = "Task not found")
+        else:
+            self.answer(200, task)
+
+# Tasks by id, and counts of requests and connections, for tests to look at
+class HabiticaServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay = 0):
+        http.server.ThreadingHTTPServer.__init__(self, address, HabiticaHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.requests = 0
+        self.connections = 0
+
+# Start a server on a free port in a background thread, returns it and its URL
+def start(delay = 0):
+    server = HabiticaServer(("127.0.0.1", 0), delay)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return (server, "http://127.0.0.1:" + str(server.server_address[1]))
+
+def main():
+    args = parser.parse_args()
+    server = HabiticaServer(("127.0.0.1", args.port), args.delay)
+    print("Serving a stand-in Habitica API on http://127.0.0.1:" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -23,30 +23,146 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE. 
 
-import pickle,os,re,datetime,argparse,string,signal,time
+import pickle,os,sys,io,re,datetime,argparse,string,time,tempfile,shutil,select,struct,threading,ctypes,ctypes.util,bisect,heapq
+import hashlib,mmap,gc,locale,json,functools,socket,socketserver,signal,concurrent.futures,itertools
+import asyncio,http.client,urllib.parse,calendar,array,collections
+
+# Optional, --report computes with it when it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Parse command-line options
 parser = argparse.ArgumentParser(description="Automate certain todo list tasks")
 parser.add_argument("--options_file", help="File to read and write options")
 parser.add_argument("--summary", action="store_true", help="Show summary of tasks")
+parser.add_argument("--report", action="store_true",
+        help="Show counts by state, project and context, task ages, time to complete and tasks done per week")
 parser.add_argument("--guided", action="store_true", help="Go through tasks needing attention step-by-step")
-args = parser.parse_args()
+parser.add_argument("--exec", metavar="FILE",
+        help="Run the commands in FILE, or - for standard input, without interaction, then save once")
+parser.add_argument("--daemon", action="store_true",
+        help="Keep the tasks in memory and serve commands from --send over a socket next to the options file")
+parser.add_argument("--send", metavar="COMMAND", action="append",
+        help="Run a command in the running daemon: summary, list [QUERY] or any batch mode command")
+parser.add_argument("--profile", action="store_true", help="Show how long each phase took after every command")
+parser.add_argument("--stats-out", help="File to keep timing statistics for the session in, as JSON")
+
+# Set by main()
+args = None
 
 # Used to see if todo.txt was modified from another program
-todo_last_modified = time.time()
 todo_externally_changed = False
 
-# Variable to store todos
+# Options, todo.txt, the cache of its parsed tasks, and the tasks with their index and scheduler, set up by main().
+# todo_files has todo.txt and the other files of the workspace, new tasks go to todo_file, the first of them.
+options = {}
+todo_file = None
+todo_files = []
+snapshot_cache = None
 local_todos = None
+todo_index = None
+todo_scheduler = None
+
+# Undo history of interactive mode
+todo_history = None
+
+# Held by the main thread in interactive mode, except while waiting for input
+todo_lock = None
 
 # Default data file location
 data_file = os.path.join(os.path.expanduser("~"), ".toadmin.txt")
-if args.options_file:
-    data_file = options.options_file
 
 # List used to filter out tasks
 filter = []
 
+# Page shown in interactive mode when paging, None shows all tasks
+page = None
+
+# Timing statistics, only collected with --profile or --stats-out
+stats = None
+
+# Time spent in each phase and counts of work done, for the current command and for the whole session
+class Stats:
+    def __init__(self):
+        # {phase: [calls, seconds]} and {counter: n} since the last command ended
+        self.phases = {}
+        self.counters = {}
+        # The same for all commands before that
+        self.total_phases = {}
+        self.total_counters = {}
+        self.commands = 0
+
+    def add(self, phase, seconds):
+        entry = self.phases.setdefault(phase, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def count(self, counter, n):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    # Add the current command to the session totals, and write them to path if given
+    def end_command(self, path = None):
+        for (phase, (calls, seconds)) in self.phases.items():
+            entry = self.total_phases.setdefault(phase, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+        for (counter, n) in self.counters.items():
+            self.total_counters[counter] = self.total_counters.get(counter, 0) + n
+
+        self.phases = {}
+        self.counters = {}
+        self.commands += 1
+
+        if path:
+            with open(path, "w") as stats_file:
+                json.dump({"commands": self.commands,
+                    "phases": {p: {"calls": c, "seconds": s} for (p, (c, s)) in self.total_phases.items()},
+                    "counters": self.total_counters}, stats_file, indent = 1, sort_keys = True)
+
+    # Breakdown of the current command, or of the session with total = True
+    def report(self, total = False):
+        phases = self.phases
+        counters = self.counters
+        title = "Profile"
+        if total:
+            phases = self.total_phases
+            counters = self.total_counters
+            title = "Profile for " + str(self.commands) + " commands"
+
+        lines = [title + ":"]
+        for (phase, (calls, seconds)) in sorted(phases.items(), key = lambda x: -x[1][1]):
+            lines.append("  %-16s %9.2f ms %6d calls" % (phase, seconds * 1000, calls))
+
+        for (counter, n) in sorted(counters.items()):
+            lines.append("  %-16s %12d" % (counter, n))
+
+        return "\n".join(lines)
+
+# Decorator adding the time spent in a function to phase. Costs one check of stats when it is off.
+def timed(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*arguments, **keywords):
+            if stats is None:
+                return function(*arguments, **keywords)
+
+            start = time.perf_counter()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                stats.add(phase, time.perf_counter() - start)
+
+        return timed_function
+
+    return decorate
+
+def count(counter, n):
+    if stats is not None:
+        stats.count(counter, n)
+
 # Define color codes
 class bcolors:
     BLACK = '\033[30m'
@@ -69,20 +185,29 @@ class bcolors:
 
 # Todo superclass, for both local and Habitica todos
 class Todo:
+    # Habitica's difficulty for priorities A to C, later letters are trivial and no priority is Habitica's default
+    habitica_priorities = {"A": 2, "B": 1.5, "C": 1}
+
+    __slots__ = ()
+
     def __str__(self):
+        return self.format()
+
+    # Build the todo.txt line. Creation date and addons can be left out for display.
+    def format(self, created = True, addons = True):
         outstr = ""
 
         if self.done:
             outstr += "x "
             if self.completed:
                 outstr += self.completed.isoformat() + " "
-            if self.created:
+            if created and self.created:
                 outstr += self.created.isoformat() + " "
 
         else:
             if self.priority:
                 outstr += self.priority
-            if self.created:
+            if created and self.created:
                 outstr += self.created.isoformat() + " "
 
         outstr += self.text
@@ -91,24 +216,19 @@ class Todo:
             outstr += " " + p
         for c in self.contexts:
             outstr += " " + c
-        for k, v in self.addons.items():
-            if type(v) == type(datetime.date.today()):
-                outstr += " " + k + ":" + v.isoformat()
 
-            else:
-                outstr += " " + k + ":" + v
+        if addons:
+            for k, v in self.addons.items():
+                if type(v) == type(datetime.date.today()):
+                    outstr += " " + k + ":" + v.isoformat()
+
+                else:
+                    outstr += " " + k + ":" + v
 
         return outstr + "\n"
 
     def human_str(self):
-        a = self.addons
-        self.addons = {}
-        c = self.created
-        self.created = None
-        s = str(self)
-        self.addons = a
-        self.created = c
-        return s.rstrip("\n")
+        return self.format(created = False, addons = False).rstrip("\n")
 
     def get_dict(self):
         d = {}
@@ -119,89 +239,356 @@ class Todo:
         if self.created:
             d['createdAt'] = self.created.isoformat()
         if self.completed:
-            d['dateCompleted'] = self.completed
+            d['dateCompleted'] = self.completed.isoformat()
         
         if "habitica_id" in self.addons:
             d['id'] = self.addons['habitica_id']
 
-        d['text'] = str(self)
+        # Only the text with its projects and contexts, Habitica has fields of its own for the rest
+        d['text'] = " ".join([self.text] + list(self.projects) + list(self.contexts))
+        d['priority'] = 1
+        if self.priority:
+            d['priority'] = Todo.habitica_priorities.get(self.priority[1], 0.1)
 
         return d
 
 
+# Addons of a task. Tells the task before anything is changed, so it knows it has to be written back.
+class Addons(dict):
+    __slots__ = ("owner",)
+
+    def __init__(self, owner, *args):
+        dict.__init__(self, *args)
+        self.owner = owner
+
+    def __setitem__(self, key, value):
+        self.owner.touch()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.owner.touch()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self.owner.touch()
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self.owner.touch()
+        return dict.pop(self, *args)
+
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self.owner.touch()
+        return dict.setdefault(self, key, default)
+
+    def clear(self):
+        self.owner.touch()
+        dict.clear(self)
+
+
+# A task from todo.txt. The line is kept as read and only parsed when one of its fields is first used. Tasks that
+# are never changed are written back exactly as they were read. Fields are slots, left empty until parsed.
 class LocalTodo(Todo):
-    def __init__(self, init_str):
-        self.done = False
-        self.created = None
-        self.completed = None
-        self.priority = None
-        self.text = ""
+    fields = frozenset(["done", "created", "completed", "priority", "text", "projects", "contexts", "addons"])
+
+    # raw: line as read or last written, stored: whether that line is in the file, origin: TodoFile it belongs to,
+    # formatted: line of a changed task and rendered: human_str(), both cached until it changes
+    __slots__ = ("raw", "parsed", "dirty", "stored", "origin", "formatted", "rendered", "done", "created",
+            "completed", "priority", "text", "projects", "contexts", "addons")
+
+    # origin is the TodoFile the line was read from, if any
+    def __init__(self, init_str, origin = None):
+        if not init_str.endswith("\n"):
+            init_str += "\n"
+
+        fill_raw(self, init_str)
+        fill_parsed(self, False)
+        fill_dirty(self, False)
+        fill_stored(self, origin is not None)
+        fill_origin(self, origin)
+        fill_formatted(self, None)
+        fill_rendered(self, None)
+
+    # Only called for fields that haven't been parsed yet
+    def __getattr__(self, name):
+        if name not in LocalTodo.fields:
+            raise AttributeError(name)
+
+        # Whether a task is done can be seen without parsing the whole line
+        if name == "done" and not self.parsed:
+            return line_is_done(self.raw)
+
+        self.parse()
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        if name in LocalTodo.fields:
+            if not self.parsed:
+                self.parse()
+            self.touch()
+
+            if name == "addons" and not isinstance(value, Addons):
+                value = Addons(self, value)
+
+            # Tags are kept as tuples of interned strings, like parse_todotext returns them
+            elif name == "projects" or name == "contexts":
+                value = tuple(sys.intern(t) for t in value)
+
+        object.__setattr__(self, name, value)
+
+    # Called before a field is changed
+    def touch(self):
+        if self.origin:
+            self.origin.touched(self)
+
+        self.dirty = True
+        self.formatted = None
+        self.rendered = None
 
-        # Search for priority, date and text (incomplete tasks)
-        incomplete_result = re.match("(\([A-Z]\) )?\s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.+)", init_str)
+    def human_str(self):
+        if self.rendered is None:
+            self.rendered = Todo.human_str(self)
+        return self.rendered
+
+    # Line to write back for this task, also used to sort tasks
+    def line(self):
+        if self.dirty:
+            if self.formatted is None:
+                self.formatted = str(self)
+            return self.formatted
+
+        return self.raw
+
+    def parse(self):
+        done = False
+        created = None
+        completed = None
+        priority = None
+
+        # Search for completeness, dates, priority and text in one match
+        result = todo_head_regex.match(self.raw)
+        if not result:
+            # TODO: Implement own exception
+            raise Exception("Couldn't parse task: " + self.raw)
 
-        # Search for completeness, completion date, creation date and text (complete tasks)
-        complete_result = re.match("x \s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?\s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.+)", 
-                init_str)
+        (complete_date, created_date, complete_text, priority, incomplete_created, incomplete_text) = result.groups()
 
-        if complete_result:
+        if complete_text is not None:
             # Task is complete
-            self.done = True
-            
-            if complete_result.group(1):
-                self.completed = datetime.datetime.strptime(complete_result.group(1).strip(), "%Y-%m-%d").date()
+            done = True
 
-            if complete_result.group(2):
-                self.created = datetime.datetime.strptime(complete_result.group(2).strip(), "%Y-%m-%d").date()
+            if complete_date:
+                completed = parse_date(complete_date[:-1])
 
-            self.text = complete_result.group(3)
+            if created_date:
+                created = parse_date(created_date[:-1])
 
-        elif incomplete_result:
-            # Task is incomplete
-            self.priority = incomplete_result.group(1)
+            text = complete_text
 
-            if incomplete_result.group(2):
-                self.created = datetime.datetime.strptime(incomplete_result.group(2).strip(), "%Y-%m-%d").date()
+        else:
+            # Task is incomplete
+            if incomplete_created:
+                created = parse_date(incomplete_created[:-1])
+
+            text = incomplete_text
+
+        (text, projects, contexts, addons) = parse_todotext(text)
+
+        fill_done(self, done)
+        fill_created(self, created)
+        fill_completed(self, completed)
+        fill_priority(self, priority)
+        fill_text(self, text)
+        fill_projects(self, projects)
+        fill_contexts(self, contexts)
+        fill_addons(self, Addons(self, addons))
+        fill_parsed(self, True)
+
+    # Set every field to what line has, as one change. Used to undo changes.
+    def restore(self, line):
+        if not self.parsed:
+            self.parse()
+        self.touch()
+
+        old = LocalTodo(line)
+        old.parse()
+        fill_done(self, old.done)
+        fill_created(self, old.created)
+        fill_completed(self, old.completed)
+        fill_priority(self, old.priority)
+        fill_text(self, old.text)
+        fill_projects(self, old.projects)
+        fill_contexts(self, old.contexts)
+        fill_addons(self, Addons(self, old.addons))
+
+    # Compact form for SnapshotCache: the line, plus the parsed fields if it has been parsed. Dates are stored as
+    # ordinals.
+    def snapshot(self):
+        if not self.parsed:
+            return self.raw
+
+        return (self.raw, self.done, self.priority, self.created and self.created.toordinal(),
+                self.completed and self.completed.toordinal(), self.text, self.projects, self.contexts,
+                dict(self.addons))
+
+# Setters for each slot of LocalTodo that go around its __setattr__, for filling in tasks being read
+(fill_raw, fill_parsed, fill_dirty, fill_stored, fill_origin, fill_formatted, fill_rendered, fill_done, fill_created,
+        fill_completed, fill_priority, fill_text, fill_projects, fill_contexts, fill_addons) = \
+        [getattr(LocalTodo, name).__set__ for name in LocalTodo.__slots__]
+
+# Task from LocalTodo.snapshot(), read from origin
+def todo_from_snapshot(record, origin):
+    if type(record) == str:
+        return LocalTodo(record, origin)
+
+    (raw, done, priority, created, completed, text, projects, contexts, addons) = record
+    todo = LocalTodo.__new__(LocalTodo)
+    fill_raw(todo, raw)
+    fill_dirty(todo, False)
+    fill_stored(todo, True)
+    fill_origin(todo, origin)
+    fill_formatted(todo, None)
+    fill_rendered(todo, None)
+    fill_done(todo, done)
+    fill_created(todo, created and date_from_ordinal(created))
+    fill_completed(todo, completed and date_from_ordinal(completed))
+    fill_priority(todo, priority)
+    fill_text(todo, text)
+    fill_projects(todo, projects)
+    fill_contexts(todo, contexts)
+    fill_addons(todo, Addons(todo, addons))
+    fill_parsed(todo, True)
+
+    return todo
+
+# Many tasks share the same few dates, so they share the date objects as well
+@functools.lru_cache(maxsize = 4096)
+def date_from_ordinal(ordinal):
+    return datetime.date.fromordinal(ordinal)
+
+# Whether a stored line is a complete task. Same answer as parsing it: "x " has to be followed by something.
+def line_is_done(line):
+    return line.startswith("x ") and line[2] != "\n"
+
+# Whether a stored line is a complete task that already carries state:done as its only state, so the automatic
+# actions would leave it alone
+def done_line_settled(line):
+    return (line_is_done(line) and line.count("state:") == 1 and
+            (" state:done " in line or line.endswith(" state:done\n")))
+
+# Head of a task line. The first alternative matches complete tasks (completion date, creation date, text), the
+# second incomplete ones (priority, creation date, text). Alternatives are tried in that order, like the two
+# separate matches this replaces.
+todo_head_regex = re.compile(r"x \s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?\s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.+)|"
+        r"(\([A-Z]\) )?\s*([0-9]{4}-[0-9]{2}-[0-9]{2} )?(.+)")
+
+# Parse a YYYY-MM-DD date. Anything that isn't exactly in that form goes through strptime, which also accepts
+# unpadded fields. Dates repeat a lot, so results are remembered.
+@functools.lru_cache(maxsize = 4096)
+def parse_date(s):
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        try:
+            return datetime.date.fromisoformat(s)
+        except ValueError:
+            pass
+
+    return datetime.datetime.strptime(s, "%Y-%m-%d").date()
+
+# How often a task recurs, the value of its rec: addon: every N days, weeks, months or years, like 1w or 3m. With
+# a + in front, like +1m, the next instance is due that long after the task was due instead of after it was done.
+class Recurrence(str):
+    __slots__ = ()
+
+    pattern = re.compile(r"(\+?)([1-9][0-9]*)([dwmy])$")
+
+    # Due date of the next instance of a task that was due on due, or None, and was done today
+    def next_due(self, due, today):
+        (strict, n, unit) = Recurrence.pattern.match(self).groups()
+        start = today
+        if strict and due:
+            start = due
+
+        n = int(n)
+        if unit == "d":
+            return start + datetime.timedelta(days = n)
+        if unit == "w":
+            return start + datetime.timedelta(weeks = n)
+        if unit == "y":
+            n *= 12
+
+        # Months end on the last day of the month when it is shorter
+        month = start.month - 1 + n
+        year = start.year + month // 12
+        month = month % 12 + 1
+        return datetime.date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+# Recurrence for text, or None if it isn't one. The same few are used by many tasks, so they share one object.
+@functools.lru_cache(maxsize = 256)
+def parse_recurrence(text):
+    if not Recurrence.pattern.match(text):
+        return None
+
+    return Recurrence(sys.intern(text))
+
+# Collect key:value addons in word, returns word with them removed. Mirrors what the addon regex
+# "([^ :]+):([^ :]+)" matches: pairs of non-empty colon-separated parts, scanning left to right.
+def scan_addons(word, addons):
+    parts = word.split(":")
+    rest = []
+    i = 0
+
+    while i < len(parts):
+        if i + 1 < len(parts) and parts[i] and parts[i + 1]:
+            if parts[i] == "due":
+                addons["due"] = parse_date(parts[i + 1].strip())
+            elif parts[i] == "rec" and parse_recurrence(parts[i + 1]):
+                addons["rec"] = parse_recurrence(parts[i + 1])
+            else:
+                addons[sys.intern(parts[i])] = parts[i + 1]
 
-            self.text = incomplete_result.group(3)
+            rest.append("")
+            i += 2
 
         else:
-            # TODO: Implement own exception
-            raise Exception("Couldn't parse task: " + init_str)
+            rest.append(parts[i])
+            i += 1
 
-        (self.text, self.projects, self.contexts, self.addons) = parse_todotext(self.text)
+    return ":".join(rest)
 
-# Returns (text, projects, contexts, addons)
+# Returns (text, projects, contexts, addons). Projects and contexts are tuples, their strings and the addon keys
+# are interned, as the same few of them are used by many tasks.
 def parse_todotext(text):
     projects = []
     contexts = []
     addons = {}
 
-    project_regex = re.compile(" \+[^ ]+")
-    context_regex = re.compile(" \@[^ ]+")
-    addon_regex = re.compile("([^ :]+):([^ :]+)")
-
-    for p in project_regex.findall(text):
-        projects.append(p.lstrip(" "))
-
-    for c in context_regex.findall(text):
-        contexts.append(c.lstrip(" "))
+    # Single scan over space-separated words. Projects and contexts need a space in front of them, so the first
+    # word is never one. Addons are picked up anywhere, also inside project and context words.
+    words = text.split(" ")
+    first = words[0]
+    if ":" in first:
+        first = scan_addons(first, addons)
+    kept = [first]
+
+    for word in words[1:]:
+        if len(word) > 1 and (word[0] == "+" or word[0] == "@"):
+            if word[0] == "+":
+                projects.append(sys.intern(word))
+            else:
+                contexts.append(sys.intern(word))
 
-    for a in addon_regex.findall(text):
-        if a[0] == "due":
-            addons[a[0]] = datetime.datetime.strptime(a[1].strip(), "%Y-%m-%d").date()
+            if ":" in word:
+                scan_addons(word, addons)
             continue
 
-        addons[a[0]] = a[1]
-
-    # Remove projects, contexts and addons from text
-    (text, n) = project_regex.subn("", text)
-    (text, n) = context_regex.subn("", text)
-    (text, n) = addon_regex.subn("", text)
+        if ":" in word:
+            word = scan_addons(word, addons)
+        kept.append(word)
 
-    text = text.strip()
+    text = " ".join(kept).strip()
 
-    return (text, projects, contexts, addons)
+    return (text, tuple(projects), tuple(contexts), addons)
 
 # Give Y/N or other prompt
 def ask_question(text, alternatives = {"Y": "Yes", "N": "No"}):
@@ -227,8 +614,8 @@ def set_priority(todo):
 def add_metadata(todo):
     d = input("Add +projects, @contexts or other data: ")
     (text, projects, contexts, addons) = parse_todotext(" " + d)
-    todo.projects += projects
-    todo.contexts += contexts
+    todo.projects = todo.projects + projects
+    todo.contexts = todo.contexts + contexts
     todo.addons.update(addons)
 
 def load_options(data_file):
@@ -237,94 +624,1509 @@ def load_options(data_file):
 def save_options(data_file, options):
     pickle.dump(options, open(data_file, "wb"))
 
-def load_todos():
-    todos = []
-
-    with open(options["todo.txt-location"], "r") as local_todos_file:
-        for line in local_todos_file.readlines():
+# A todo.txt file. Keeps track of which tasks have to be written, so that saving only touches the file when
+# something changed.
+class TodoFile:
+    # With journal, changes are appended to a Journal next to the file instead of rewriting it
+    def __init__(self, path, journal = False):
+        self.path = path
+        # Modification time of the file after our last read or write
+        self.last_modified = None
+        # Number of tasks in the file
+        self.stored_count = 0
+        # Tasks that are changed or added since the last save, in order
+        self.pending = {}
+        # Objects whose changed() is called before one of our tasks changes
+        self.listeners = []
+        # Identifies the contents last read, see SnapshotCache
+        self.snapshot_key = None
+        # Finished tasks are moved to done.txt next to the file
+        self.archive = DoneArchive(os.path.join(os.path.dirname(os.path.abspath(path)), "done.txt"))
+        self.journal = None
+        if journal:
+            self.journal = Journal(journal_path(path))
+
+    # Lines of the file, without empty ones and all ending in a newline, with the journal played over them
+    def lines(self, text_lines):
+        lines = []
+        for line in text_lines:
             if line.strip():
-                todos.append(LocalTodo(line))
+                if not line.endswith("\n"):
+                    line += "\n"
+                lines.append(line)
 
-    return todos
+        if self.journal is not None:
+            lines = self.journal.replay(lines)
 
+        return lines
 
-def save_todos(local_todos):
-    global todo_last_modified
+    # Read all tasks. If cache has a snapshot of exactly this file, the tasks are taken from it instead of parsing.
+    # Large files are parsed by a pool of workers processes, by default one per core.
+    def load(self, cache = None, workers = None):
+        with open(self.path, "rb") as todo_file:
+            data = todo_file.read()
+            stat = os.fstat(todo_file.fileno())
+            self.last_modified = stat.st_mtime
 
-    with open(options["todo.txt-location"], "w") as local_todos_file:
-        for todo in local_todos:
-            local_todos_file.write(str(todo))
+        if workers is None:
+            workers = 1
+            if len(data) >= parallel_load_size:
+                workers = os.cpu_count() or 1
 
-    todo_last_modified = time.time()
+        self.snapshot_key = snapshot_key(data, self.last_modified)
+
+        # Creating this many objects would otherwise set off collections that can't free anything
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            records = None
+            # The snapshot is of the file alone, it can't be used while the journal has changes to it
+            if cache and not (self.journal is not None and self.journal.read()):
+                records = cache.get(self.path, self.snapshot_key)
+
+            if records is None and self.journal is None and workers > 1:
+                records = parse_in_pool(self.path, data, (stat.st_size, stat.st_mtime_ns), workers)
+
+            if records is not None:
+                todos = [todo_from_snapshot(r, self) for r in records]
+
+            elif self.journal is not None:
+                lines = self.lines(io.TextIOWrapper(io.BytesIO(data)).readlines())
+                self.journal.forget_compacted()
+                todos = [LocalTodo(line, self) for line in lines]
+
+            else:
+                todos = []
+                # Decode like open(path, "r") would
+                for line in io.TextIOWrapper(io.BytesIO(data)).readlines():
+                    if line.strip():
+                        todos.append(LocalTodo(line, self))
+
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.stored_count = len(todos)
+        self.pending = {}
+
+        return todos
+
+    # Store todos in cache, unless they don't match the file or the cache already has them
+    def save_snapshot(self, cache, todos):
+        if self.pending or self.modified_externally() or (self.journal is not None and self.journal.read()):
+            return
+
+        with open(self.path, "rb") as todo_file:
+            data = todo_file.read()
+        key = snapshot_key(data, self.last_modified)
+
+        if key != self.snapshot_key or not cache.has(self.path, key):
+            by_line = {}
+            for todo in todos:
+                if todo.origin is self:
+                    by_line.setdefault(todo.raw, []).append(todo)
+
+            # In the order of the lines, so loading from the snapshot gives the tasks in the order parsing would
+            records = []
+            for line in self.lines(io.TextIOWrapper(io.BytesIO(data)).readlines()):
+                same = by_line.get(line)
+                if not same:
+                    return
+                records.append(same.pop().snapshot())
+
+            if any(by_line.values()):
+                return
+
+            cache.put(self.path, key, records)
+            self.snapshot_key = key
+
+    # Read the file again after it was changed elsewhere, merging the changes with the ones made here. The line
+    # each task had when it was last read or saved is the base: tasks whose base line is still in the file are kept
+    # as they are, only new or changed lines are parsed. A task changed here whose line was changed in the file too
+    # is merged with the task on the new line with the same text, field by field. Fields changed on both sides
+    # keep the change made here and are reported as conflicts. If there is no such task, the line was removed or
+    # its text changed, and the task is kept as a new one next to it. Tasks added here but not saved yet are kept
+    # as well. Returns (added, removed, conflicts), where conflicts are messages.
+    @timed("reload")
+    def reload(self, todos):
+        existing = {}
+        for todo in todos:
+            if todo.stored and todo.origin is self:
+                existing.setdefault(todo.raw, []).append(todo)
+
+        last_modified = os.path.getmtime(self.path)
+        kept = set()
+        added = []
+        stored = 0
+
+        with open(self.path, "r") as todo_file:
+            for line in self.lines(todo_file.readlines()):
+                stored += 1
+                same = existing.get(line)
+                if same:
+                    kept.add(same.pop())
+
+                else:
+                    added.append(LocalTodo(line, self))
+
+        if self.journal is not None:
+            self.journal.forget_compacted()
+
+        # Tasks changed here whose line was changed in the file, with their base line. Those whose change is in the
+        # journal but couldn't be played over the file are changed here too.
+        changed = [(t, t.raw) for t in self.pending if t.stored and t.origin is self and t not in kept]
+        if self.journal is not None:
+            unapplied = self.journal.unapplied
+            changed += [(t, unapplied[t.raw]) for t in todos
+                    if t.origin is self and t.stored and t not in kept and t.raw in unapplied]
+
+        conflicts = []
+        if changed:
+            # Only the changed lines are looked at to find the other side of a merge
+            by_text = {}
+            for todo in added:
+                by_text.setdefault(todo.text, []).append(todo)
+
+            merged = set()
+            for (todo, base_line) in changed:
+                # The task has to be written again, from its fields
+                if not todo.dirty:
+                    todo.touch()
+
+                base = LocalTodo(base_line)
+                theirs = [t for t in by_text.get(base.text, []) if t not in merged]
+                if theirs:
+                    merged.add(theirs[0])
+                    fields = merge_todo(base, todo, theirs[0])
+                    todo.raw = theirs[0].raw
+                    kept.add(todo)
+                    if fields:
+                        conflicts.append("Conflict in \"" + todo.text + "\": " + ", ".join(fields) +
+                                " changed in both, kept the change made here")
+
+                else:
+                    todo.stored = False
+                    conflicts.append("Conflict in \"" + todo.text + "\": changed here but removed or changed in " +
+                            os.path.basename(self.path) + ", kept both")
+
+            added = [t for t in added if t not in merged]
+
+        removed = [t for t in todos if t.origin is self and t.stored and t not in kept]
+
+        self.last_modified = last_modified
+        self.stored_count = stored
+        self.pending = {t: True for t in self.pending if t in kept or not t.stored}
+        count("tasks reparsed", len(added))
+
+        return (added, removed, conflicts)
+
+    # Called by a task before it changes
+    def touched(self, todo):
+        self.pending[todo] = True
+        for listener in self.listeners:
+            listener.changed(todo)
+
+    # Add a new task, written on the next save
+    def add(self, todo):
+        todo.origin = self
+        self.pending[todo] = True
+
+    def modified_externally(self):
+        return os.path.getmtime(self.path) != self.last_modified
+
+    # Write todos if anything changed. New tasks alone are appended, anything else replaces the file.
+    def save(self, todos):
+        if not self.pending and len(todos) == self.stored_count:
+            return False
+
+        new = [t for t in self.pending if not t.stored]
+
+        # Changes and new tasks go to the journal. Removing tasks writes the whole file.
+        if self.journal is not None and len(todos) == self.stored_count + len(new):
+            return self.save_journal(todos)
+
+        for todo in self.pending:
+            todo.raw = todo.line()
+
+        # Where the written part of the file starts
+        offset = 0
+        if len(new) == len(self.pending) and len(todos) == self.stored_count + len(new):
+            missing_newline = not self.ends_with_newline()
+            with open(self.path, "a") as todo_file:
+                offset = todo_file.tell()
+                # Otherwise the first new task would be joined to the last line
+                if missing_newline:
+                    todo_file.write("\n")
+                for todo in new:
+                    todo_file.write(todo.raw)
+
+        else:
+            self.replace(todos)
+            # Everything in the journal is in the file now
+            if self.journal is not None:
+                self.journal.clear()
+
+        for todo in self.pending:
+            todo.dirty = False
+            todo.stored = True
+
+        self.last_modified = os.path.getmtime(self.path)
+        self.stored_count = len(todos)
+        self.pending = {}
+
+        if stats is not None:
+            stats.count("bytes written", os.path.getsize(self.path) - offset)
 
-def filter_match(task, filter):
-    if len(filter) == 0:
         return True
 
-    for i in filter:
-        match = False
-        for j in task.projects:
-            if i == j:
-                match = True
-                break
+    # Whether the file is empty or its last line ends with a newline
+    def ends_with_newline(self):
+        with open(self.path, "rb") as todo_file:
+            if todo_file.seek(0, os.SEEK_END) == 0:
+                return True
+
+            todo_file.seek(-1, os.SEEK_END)
+            return todo_file.read(1) == b"\n"
 
-        if not match:
+    # Append the pending changes to the journal, as the line each task had and the line it has now. The journal is
+    # written into the file once it gets long.
+    def save_journal(self, todos):
+        records = []
+        for todo in self.pending:
+            line = todo.line()
+            records.append((todo.raw if todo.stored else None, line))
+            todo.raw = line
+            todo.dirty = False
+            todo.stored = True
+
+        written = self.journal.append(records)
+        self.stored_count = len(todos)
+        self.pending = {}
+
+        if stats is not None:
+            stats.count("bytes written", written)
+
+        if len(self.journal.read()) >= Journal.limit:
+            self.compact(todos)
+
+        return True
+
+    # Write the journal into the file, if it has anything
+    def compact(self, todos):
+        if self.journal is None or not self.journal.read():
             return False
 
-    return True
+        self.replace(todos)
+        self.journal.clear()
+        self.last_modified = os.path.getmtime(self.path)
 
+        if stats is not None:
+            stats.count("bytes written", os.path.getsize(self.path))
 
-# Get string showing numbered, grouped tasks. Returns (str, index_list)
-def get_interactive_task_list(tasks, filter = []):
-    global options
+        return True
 
-    next = []
-    today = []
-    scheduled = []
-    waiting = []
-    someday = []
-    new = []
-    other = []
+    # Write all todos to a temporary file next to todo.txt and rename it over the original, so the file is never
+    # seen half-written. The journal is marked first, so that if it isn't cleared after this, it isn't played again.
+    def replace(self, todos):
+        if self.journal is not None and self.journal.read():
+            self.journal.compacting(lines_hash(t.line() for t in todos))
 
-    return_string = ""
+        path = os.path.realpath(self.path)
+        (fd, tmp_path) = tempfile.mkstemp(dir = os.path.dirname(path), prefix = "." + os.path.basename(path) + ".")
 
-    for task in local_todos:
-        if task.done:
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                for todo in todos:
+                    tmp_file.write(todo.line())
+
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+
+            os.replace(tmp_path, path)
+
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+# Merge the changes from base to theirs into ours, which was changed from base as well. Returns the names of fields
+# and addons changed differently in both, those keep the value in ours.
+def merge_todo(base, ours, theirs):
+    conflicts = []
+    for name in ["done", "completed", "created", "priority", "text", "projects", "contexts"]:
+        (b, o, t) = (getattr(base, name), getattr(ours, name), getattr(theirs, name))
+        if o == b and t != b:
+            setattr(ours, name, t)
+        elif o != b and t != b and o != t:
+            conflicts.append(name)
+
+    keys = list(base.addons) + [k for k in ours.addons if k not in base.addons]
+    keys += [k for k in theirs.addons if k not in keys]
+    for key in keys:
+        (b, o, t) = (base.addons.get(key), ours.addons.get(key), theirs.addons.get(key))
+        if o == b and t != b:
+            if t is None:
+                del ours.addons[key]
+            else:
+                ours.addons[key] = t
+        elif o != b and t != b and o != t:
+            conflicts.append(key)
+
+    return conflicts
+
+# Files at least this large are parsed in parallel by TodoFile.load
+parallel_load_size = 8 * 1024 * 1024
+
+# Records like LocalTodo.snapshot() gives for the tasks in the bytes from start to end of the file at path, parsed
+# in a worker process. Finished tasks the automatic actions would leave alone, and lines that fail to parse, are
+# left as lines, as they would be when loaded here. Returns None if the file isn't the one stat was taken of.
+def parse_chunk(path, start, end, stat):
+    with open(path, "rb") as todo_file:
+        found = os.fstat(todo_file.fileno())
+        if (found.st_size, found.st_mtime_ns) != stat:
+            return None
+
+        with mmap.mmap(todo_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            chunk = data[start:end]
+
+    records = []
+    for line in io.TextIOWrapper(io.BytesIO(chunk)).readlines():
+        if not line.strip():
             continue
 
-        if not filter_match(task, filter) and not options["filter-color"]:
+        todo = LocalTodo(line)
+        if done_line_settled(todo.raw):
+            records.append(todo.raw)
             continue
 
-        if not "state" in task.addons:
-            other.append(task)
+        try:
+            todo.parse()
+        except Exception:
+            pass
+        records.append(todo.snapshot())
+
+    return records
+
+# Parse data, read from path, in a pool of workers. The file is split into line-aligned parts, a few per worker,
+# which each worker maps into memory and parses by itself. Records come back in file order, or None if the file
+# changed in the meantime.
+def parse_in_pool(path, data, stat, workers):
+    parts = workers * 4
+    bounds = []
+    start = 0
+    for i in range(1, parts):
+        end = data.find(b"\n", max(len(data) * i // parts, start))
+        if end < 0:
+            break
+        bounds.append((start, end + 1))
+        start = end + 1
+    bounds.append((start, len(data)))
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(parse_chunk, itertools.repeat(path), [b[0] for b in bounds],
+                [b[1] for b in bounds], itertools.repeat(stat)))
+
+    if any(r is None for r in results):
+        return None
+
+    count("tasks parsed in parallel", sum(len(r) for r in results))
+    return list(itertools.chain.from_iterable(results))
+
+# Path of the journal for a todo.txt, a hidden file next to it
+def journal_path(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "." + os.path.basename(path) + ".journal")
+
+# Hash of the text of lines, identifying the file a compaction of the journal writes
+def lines_hash(lines):
+    h = hashlib.blake2b(digest_size = 16)
+    for line in lines:
+        h.update(line.encode("utf-8"))
+    return h.hexdigest()
+
+# Changes to a todo.txt not yet written into it. Each record is a JSON line [old, new]: the line of a task before
+# and after a change, where old is null for a new task and new null for a removed one. Records are appended and
+# synced to disk before a save returns, and played over the file in order when it is read. A line cut off by a
+# crash ends the journal. Before the records are written into the file, a line {"compacted": hash} with the
+# lines_hash of the new file is appended, so records already in the file aren't played again after a crash.
+class Journal:
+    # Number of records after which the journal is written into the file
+    limit = 1000
+
+    def __init__(self, path):
+        self.path = path
+        # Records in the file, read on first use
+        self.records = None
+        # Lines from records that couldn't be played in the last replay, and the line they were changed from
+        # before that, see replay()
+        self.unapplied = {}
+        # (number of records, hash) for each compaction started, and the number of records the last replay found
+        # in the file already
+        self.marks = []
+        self.compacted = 0
+
+    def read(self):
+        if self.records is not None:
+            return self.records
+
+        self.records = []
+        try:
+            with open(self.path, "rb") as journal_file:
+                for line in journal_file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                        if isinstance(record, dict):
+                            self.marks.append((len(self.records), record["compacted"]))
+                            continue
+                        (old, new) = record
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    self.records.append((old, new))
 
-        else:
-            if task.addons['state'] == "next":
-                next.append(task)
-            
-            elif task.addons['state'] == "today":
-                today.append(task)
-            
-            elif task.addons['state'] == "scheduled":
-                scheduled.append(task)
-            
-            elif task.addons['state'] == "waiting":
-                waiting.append(task)
-            
-            elif task.addons['state'] == "someday":
-                someday.append(task)
-
-            elif task.addons['state'] == "new":
-                new.append(task)
+        except FileNotFoundError:
+            pass
+
+        return self.records
+
+    def write(self, journal_file, data):
+        journal_file.write(data)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+    # Append records of lines with their newline, returns the number of bytes written
+    def append(self, records):
+        records = [(old and old.rstrip("\n"), new and new.rstrip("\n")) for (old, new) in records]
+        data = "".join(json.dumps(r, ensure_ascii = False) + "\n" for r in records).encode("utf-8")
+
+        with open(self.path, "ab") as journal_file:
+            self.write(journal_file, data)
+
+        self.read().extend(records)
+        return len(data)
+
+    # Mark the records so far as being written into the file, which will have the lines with the given lines_hash
+    def compacting(self, hash):
+        records = self.read()
+        with open(self.path, "ab") as journal_file:
+            self.write(journal_file, (json.dumps({"compacted": hash}) + "\n").encode("utf-8"))
+        self.marks.append((len(records), hash))
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.records = []
+        self.marks = []
+        self.compacted = 0
+
+    # Drop the records the last replay found in the file already. They could be played again once the file is
+    # changed elsewhere. The rest are written to a new journal that replaces this one.
+    def forget_compacted(self):
+        if not self.compacted:
+            return
+
+        records = self.records[self.compacted:]
+        if not records:
+            self.clear()
+            return
+
+        data = "".join(json.dumps(r, ensure_ascii = False) + "\n" for r in records).encode("utf-8")
+        (fd, tmp_path) = tempfile.mkstemp(dir = os.path.dirname(self.path), prefix = os.path.basename(self.path) + ".")
+        try:
+            with os.fdopen(fd, "wb") as journal_file:
+                self.write(journal_file, data)
+            os.replace(tmp_path, self.path)
+
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self.records = records
+        self.marks = []
+        self.compacted = 0
+
+    # Lines after playing the records over them. A change is made to the first line equal to its old line. Changes
+    # to lines that aren't there any more, because the file was changed elsewhere, are left out; their new lines
+    # are kept in unapplied, with the line in the file they were first changed from. If a compaction already wrote
+    # the file as it is now, the records before it are in the file and left out.
+    def replay(self, lines):
+        records = self.read()
+        self.unapplied = {}
+        self.compacted = 0
+        if self.marks:
+            found = lines_hash(lines)
+            for (position, hash) in self.marks:
+                if hash == found:
+                    self.compacted = position
+            records = records[self.compacted:]
+
+        if not records:
+            return lines
+
+        lines = list(lines)
+        places = {}
+        for i in range(len(lines)):
+            places.setdefault(lines[i], []).append(i)
+
+        for (old, new) in records:
+            if old is None:
+                i = len(lines)
+                lines.append(None)
 
             else:
-                return_string += "Warning: unrecognized state: " + task.addons['state'] + "\n"
-                other.append(task)
+                found = places.get(old + "\n")
+                if not found:
+                    # Later changes of a change left out are left out as well
+                    first = self.unapplied.pop(old + "\n", old + "\n")
+                    if new is not None:
+                        self.unapplied[new + "\n"] = first
+                    continue
+                i = found.pop(0)
+
+            lines[i] = None
+            if new is not None:
+                lines[i] = new + "\n"
+                places.setdefault(lines[i], []).append(i)
+
+        return [line for line in lines if line is not None]
+
+# Watches a file for changes. Uses inotify where the C library has it, otherwise wait() polls, waiting longer
+# each time nothing changed.
+class FileWatcher:
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+
+    poll_min = 1
+    poll_max = 16
+
+    def __init__(self, path):
+        path = os.path.realpath(path)
+        self.name = os.path.basename(path).encode()
+        self.interval = FileWatcher.poll_min
+        self.fd = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                return
+
+            # Watch the directory, since many programs replace the file instead of writing to it
+            if libc.inotify_add_watch(fd, os.path.dirname(path).encode(),
+                    FileWatcher.IN_CLOSE_WRITE | FileWatcher.IN_MOVED_TO) < 0:
+                os.close(fd)
+                return
+
+            self.fd = fd
+
+        except (OSError, AttributeError):
+            pass
+
+    # Block until the file may have changed
+    def wait(self):
+        if self.fd is None:
+            time.sleep(self.interval)
+            self.interval = min(self.interval * 2, FileWatcher.poll_max)
+            return
+
+        while True:
+            select.select([self.fd], [], [])
+            events = os.read(self.fd, 4096)
+
+            offset = 0
+            while offset < len(events):
+                (wd, mask, cookie, length) = struct.unpack_from("iIII", events, offset)
+                name = events[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+
+                if name == self.name:
+                    return
+
+    # A change was found, check often again
+    def reset(self):
+        self.interval = FileWatcher.poll_min
+
+# Tasks sorted by their line. Changed tasks are only moved to their new place when the list is used next, by
+# bisection on the cached lines.
+class TodoList:
+    # Changed tasks are merged back in one pass once there are more than 1 in this many of the tasks
+    merge_fraction = 256
+
+    @timed("sort")
+    def __init__(self, todos = ()):
+        self.todos = sorted(todos, key = lambda x: x.line())
+        self.keys = [t.line() for t in self.todos]
+        # Number of tasks from each file
+        self.counts = {}
+        for todo in self.todos:
+            self.counts[todo.origin] = self.counts.get(todo.origin, 0) + 1
+        # Changed tasks and the line they are sorted by
+        self.moved = {}
+        # TodoIndex objects kept up to date with the list
+        self.indexes = []
+
+    def __iter__(self):
+        self.place()
+        return iter(self.todos)
+
+    def __len__(self):
+        return len(self.todos)
+
+    def __contains__(self, todo):
+        self.place()
+        return self.find(todo, todo.line()) is not None
+
+    # The tasks read from or added to origin, in order. With only one file that is the whole list.
+    def of(self, origin):
+        if self.counts.keys() == {origin}:
+            return self
+
+        self.place()
+        return [t for t in self.todos if t.origin is origin]
+
+    # Number of tasks from origin
+    def count(self, origin):
+        return self.counts.get(origin, 0)
+
+    # Count todo as added, n = 1, or removed, n = -1
+    def counted(self, todo, n):
+        self.counts[todo.origin] = self.counts.get(todo.origin, 0) + n
+        if not self.counts[todo.origin]:
+            del self.counts[todo.origin]
+
+    # Called before a task changes, while line() is still the one it is sorted by
+    def changed(self, todo):
+        if todo not in self.moved:
+            key = todo.line()
+            if self.find(todo, key) is None:
+                return
+            self.moved[todo] = key
+
+        for index in self.indexes:
+            index.changed(todo)
+
+    def add(self, todo):
+        self.place()
+        key = todo.line()
+        i = bisect.bisect_right(self.keys, key)
+        self.todos.insert(i, todo)
+        self.keys.insert(i, key)
+        self.counted(todo, 1)
+
+        for index in self.indexes:
+            index.add(todo)
+
+    def remove(self, todo):
+        self.place()
+        i = self.find(todo, todo.line())
+        del self.todos[i]
+        del self.keys[i]
+        self.counted(todo, -1)
+
+        for index in self.indexes:
+            index.remove(todo)
+
+    # Remove many tasks in one pass over the list
+    def remove_all(self, todos):
+        self.place()
+        todos = set(todos)
+        kept = [i for i in range(len(self.todos)) if self.todos[i] not in todos]
+        self.todos = [self.todos[i] for i in kept]
+        self.keys = [self.keys[i] for i in kept]
+
+        for index in self.indexes:
+            for todo in todos:
+                index.remove(todo)
+
+        for todo in todos:
+            self.counted(todo, -1)
+
+    # Position of todo, which is sorted by key, or None if it isn't in the list
+    def find(self, todo, key):
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.todos[i] is todo:
+                return i
+            i += 1
+
+        return None
+
+    # Move changed tasks to where they belong now
+    @timed("sort")
+    def place(self):
+        if not self.moved:
+            return
+
+        moved = self.moved
+        self.moved = {}
+
+        # Many changed tasks are taken out in one pass and put after the rest. Sorting then keeps the sorted run of
+        # the rest as it is, instead of moving each task over the whole list. The sort is stable, so like
+        # bisect_right changed tasks go after unchanged ones with the same line.
+        if len(moved) * TodoList.merge_fraction > len(self.todos):
+            kept = [i for i in range(len(self.todos)) if self.todos[i] not in moved]
+            todos = [self.todos[i] for i in kept] + list(moved)
+            keys = [self.keys[i] for i in kept] + [t.line() for t in moved]
+            order = sorted(range(len(keys)), key = keys.__getitem__)
+            self.todos = [todos[i] for i in order]
+            self.keys = [keys[i] for i in order]
+            return
+
+        for (todo, key) in moved.items():
+            i = self.find(todo, key)
+            del self.todos[i]
+            del self.keys[i]
+
+            key = todo.line()
+            i = bisect.bisect_right(self.keys, key)
+            self.todos.insert(i, todo)
+            self.keys.insert(i, key)
+
+# Sets of tasks by state, project and context, and the scheduled tasks ordered by due date, kept up to date with a
+# TodoList. Done tasks are only indexed by state, they are never listed. Like TodoList, changed tasks are taken out
+# right away and indexed again when the index is used next.
+class TodoIndex:
+    def __init__(self, todo_list):
+        # State to set of tasks. Done tasks are under "done", open tasks without state under None
+        self.states = {}
+        self.projects = {}
+        self.contexts = {}
+        # Tasks in state scheduled, sorted by (due, line)
+        self.scheduled = []
+        self.scheduled_keys = []
+        self.moved = set()
+
+        for todo in todo_list:
+            self.add(todo)
+        todo_list.indexes.append(self)
+
+    def add(self, todo):
+        if todo.done:
+            self.states.setdefault("done", set()).add(todo)
+            return
+
+        state = todo.addons.get("state")
+        self.states.setdefault(state, set()).add(todo)
+
+        for p in todo.projects:
+            self.projects.setdefault(p, set()).add(todo)
+        for c in todo.contexts:
+            self.contexts.setdefault(c, set()).add(todo)
+
+        if state == "scheduled":
+            key = scheduled_key(todo)
+            i = bisect.bisect_right(self.scheduled_keys, key)
+            self.scheduled.insert(i, todo)
+            self.scheduled_keys.insert(i, key)
+
+    def remove(self, todo):
+        if todo in self.moved:
+            self.moved.discard(todo)
+            return
+
+        if todo.done:
+            self.states["done"].discard(todo)
+            return
+
+        state = todo.addons.get("state")
+        self.states[state].discard(todo)
+
+        for p in todo.projects:
+            self.projects[p].discard(todo)
+        for c in todo.contexts:
+            self.contexts[c].discard(todo)
+
+        if state == "scheduled":
+            key = scheduled_key(todo)
+            i = bisect.bisect_left(self.scheduled_keys, key)
+            while self.scheduled[i] is not todo:
+                i += 1
+            del self.scheduled[i]
+            del self.scheduled_keys[i]
+
+    # Called before a task in the list changes, while its fields are still the indexed ones
+    def changed(self, todo):
+        if todo not in self.moved:
+            self.remove(todo)
+            self.moved.add(todo)
+
+    def update(self):
+        if self.moved:
+            moved = self.moved
+            self.moved = set()
+            for todo in moved:
+                self.add(todo)
+
+    # Tasks in state, optionally only those also in the set within, sorted by line
+    def tasks(self, state, within = None):
+        self.update()
+        tasks = self.states.get(state, ())
+        if within is not None:
+            tasks = within.intersection(tasks)
+
+        return sorted(tasks, key = lambda x: x.line())
+
+    # Scheduled tasks by due date, optionally only those also in the set within
+    def scheduled_tasks(self, within = None):
+        self.update()
+        if within is None:
+            return list(self.scheduled)
+
+        return [t for t in self.scheduled if t in within]
+
+    # States other than the ones get_interactive_task_list groups by
+    def other_states(self):
+        self.update()
+        return [s for s in self.states if self.states[s] and s not in ["next", "today", "scheduled", "waiting",
+                "someday", "new", "done"]]
+
+    # Sets of the tasks with a project, a context or in a state. These are the index's own sets, not to be changed.
+    def project_tasks(self, project):
+        self.update()
+        return self.projects.get(project, frozenset())
+
+    def context_tasks(self, context):
+        self.update()
+        return self.contexts.get(context, frozenset())
+
+    def state_tasks(self, state):
+        self.update()
+        return self.states.get(state, frozenset())
+
+    # All tasks that aren't done
+    def open_tasks(self):
+        self.update()
+        return set().union(*[self.states[s] for s in self.states if s != "done"])
+
+# Scheduled and waiting tasks with a due date, in a heap by due date, so that the ones becoming due can be moved to
+# today without looking at any other task. Kept up to date with a TodoList like TodoIndex. Tasks that change or
+# are removed are dropped from entries and left in the heap, where they are skipped when they come up.
+class DueScheduler:
+    def __init__(self, todo_list):
+        # Heap of [due, sequence number, task], and the current one of those for each task
+        self.heap = []
+        self.entries = {}
+        self.count = 0
+        self.moved = set()
+
+        for todo in todo_list:
+            self.add(todo)
+        todo_list.indexes.append(self)
+
+    def add(self, todo):
+        if todo.done or todo.addons.get("state") not in ["scheduled", "waiting"] or "due" not in todo.addons:
+            return
+
+        entry = [todo.addons["due"], self.count, todo]
+        self.count += 1
+        self.entries[todo] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, todo):
+        self.moved.discard(todo)
+        self.entries.pop(todo, None)
+
+    def changed(self, todo):
+        self.entries.pop(todo, None)
+        self.moved.add(todo)
+
+    def update(self):
+        if self.moved:
+            moved = self.moved
+            self.moved = set()
+            for todo in moved:
+                self.add(todo)
+
+        # Drop skipped entries once they make up most of the heap
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    # Move tasks due by today to today, returns them
+    def promote(self, today = None):
+        if today is None:
+            today = datetime.date.today()
+
+        self.update()
+        promoted = []
+        while self.heap and self.heap[0][0] <= today:
+            entry = heapq.heappop(self.heap)
+            todo = entry[2]
+            if self.entries.get(todo) is entry:
+                promoted.append(todo)
+
+        for todo in promoted:
+            todo.addons["state"] = "today"
+
+        # Promoting changed the tasks, take them out of moved again so they aren't looked at for nothing
+        self.update()
+        count("tasks promoted", len(promoted))
+
+        return promoted
+
+# Undo and redo for interactive mode. A step holds what one command changed: the line each changed task had before,
+# and the tasks it added and removed. Unchanged tasks are never copied, so a step takes memory in proportion to its
+# edit, not to the list. Kept up to date with a TodoList like TodoIndex. The oldest steps are dropped past limit.
+class History:
+    limit = 100
+
+    def __init__(self, todo_list, limit = None):
+        self.todo_list = todo_list
+        self.limit = limit or History.limit
+        self.undo_steps = []
+        self.redo_steps = []
+        # The step being recorded
+        self.lines = {}
+        self.added = []
+        self.removed = []
+
+        todo_list.indexes.append(self)
+
+    def add(self, todo):
+        self.added.append(todo)
+
+    def remove(self, todo):
+        self.removed.append(todo)
+
+    # Called before todo changes, only its line before the first change is needed
+    def changed(self, todo):
+        if todo not in self.lines:
+            self.lines[todo] = todo.line()
+
+    # The step recorded since the last one, or None if nothing changed
+    def take(self):
+        step = (self.lines, self.added, self.removed)
+        self.lines = {}
+        self.added = []
+        self.removed = []
+
+        if not any(step):
+            return None
+        return step
+
+    # End the step for a command. A new change can't be redone over.
+    def commit(self):
+        step = self.take()
+        if step is None:
+            return
+
+        self.undo_steps.append(step)
+        if len(self.undo_steps) > self.limit:
+            del self.undo_steps[0]
+        self.redo_steps = []
+        count("undo steps", 1)
+
+    # Forget changes that shouldn't be undone, like those made elsewhere
+    def discard(self):
+        self.take()
+
+    # Undo the last step, returns whether there was one. What undoing it changes is recorded as the step to redo.
+    def undo(self):
+        self.commit()
+        if not self.undo_steps:
+            return False
+
+        self.apply(self.undo_steps.pop())
+        step = self.take()
+        if step is not None:
+            self.redo_steps.append(step)
+        return True
+
+    def redo(self):
+        self.commit()
+        if not self.redo_steps:
+            return False
+
+        self.apply(self.redo_steps.pop())
+        step = self.take()
+        if step is not None:
+            self.undo_steps.append(step)
+        return True
+
+    # Revert step. Tasks that were removed since, by a reload or by archiving, are left alone.
+    def apply(self, step):
+        (lines, added, removed) = step
+        # A task finished by the step and archived since stays done, and so do the tasks the step added, which may
+        # be the next instances of recurring ones
+        archived = any(todo not in self.todo_list and todo.done for todo in lines)
+
+        # Removed tasks are gone from their file, they are written again as new ones
+        for todo in removed:
+            if todo not in self.todo_list:
+                todo.stored = False
+                todo.origin.add(todo)
+                self.todo_list.add(todo)
+
+        for (todo, line) in lines.items():
+            if todo in self.todo_list:
+                todo.restore(line)
+
+        for todo in added:
+            if todo in self.todo_list and not archived:
+                self.todo_list.remove(todo)
+                todo.origin.pending.pop(todo, None)
+
+# Numbers for tasks that stay the same while tasks come and go, for batch commands sent to the daemon. Tasks are
+# numbered from 1 in the order they were read, new tasks get the next numbers. Works as the list run_command
+# expects, tasks[N] is the task numbered N.
+class TaskNumbers:
+    def __init__(self, todos):
+        self.tasks = [None]
+        self.numbers = {}
+        for todo in todos:
+            self.append(todo)
+
+    def __getitem__(self, number):
+        return self.tasks[number]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def append(self, todo):
+        self.numbers[todo] = len(self.tasks)
+        self.tasks.append(todo)
+
+    def remove(self, todo):
+        self.tasks[self.numbers.pop(todo)] = None
+
+# Scheduled tasks are listed by due date, then by line
+def scheduled_key(todo):
+    return (todo.addons.get("due", datetime.date.max), todo.line())
+
+# Version of the records written by LocalTodo.snapshot(), snapshots of other versions are never used
+snapshot_version = 3
+
+# Identifies the contents of a todo.txt file for SnapshotCache
+def snapshot_key(data, last_modified):
+    return (snapshot_version, len(data), last_modified, hashlib.blake2b(data, digest_size = 16).digest())
+
+# Parsed tasks of todo.txt files, so that starting up can skip parsing while a file is unchanged. One file next to
+# the options file holds an entry per todo.txt path: its snapshot_key and the pickled task snapshots. The tasks of
+# an entry are only unpickled when its key matches.
+class SnapshotCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+
+    def read(self):
+        if self.entries is not None:
+            return self.entries
+
+        self.entries = {}
+        try:
+            with open(self.path, "rb") as cache_file:
+                with mmap.mmap(cache_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                    self.entries = pickle.loads(data)
+
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            # Missing or broken, it will be written again
+            pass
+
+        return self.entries
+
+    def has(self, todo_path, key):
+        return todo_path in self.read() and self.read()[todo_path][0] == key
+
+    # Task snapshots for todo_path, or None if there are none for this key
+    def get(self, todo_path, key):
+        if not self.has(todo_path, key):
+            return None
+
+        return pickle.loads(self.read()[todo_path][1])
 
-    scheduled.sort(key = lambda x: x.addons["due"])
+    def put(self, todo_path, key, records):
+        entries = self.read()
+        entries[todo_path] = (key, pickle.dumps(records, pickle.HIGHEST_PROTOCOL))
 
-    index_list = next + today + scheduled + waiting + someday + new +other
+        (fd, tmp_path) = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)),
+                prefix = "." + os.path.basename(self.path) + ".")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                pickle.dump(entries, tmp_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+# done.txt, where finished tasks are archived. Tasks are only ever appended. For looking up old tasks an index of
+# line offsets by project and context is kept, and extended with whatever was appended since it was last used.
+class DoneArchive:
+    def __init__(self, path):
+        self.path = path
+        # Start of each line, and the lines having each project or context
+        self.offsets = []
+        self.tags = {}
+        # Bytes of the file covered by the index
+        self.size = 0
+
+    # Append the lines of todos in one write
+    def append(self, todos):
+        with open(self.path, "a") as done_file:
+            done_file.write("".join([t.line() for t in todos]))
+            done_file.flush()
+            os.fsync(done_file.fileno())
+
+    def update(self):
+        if not os.path.isfile(self.path):
+            self.__init__(self.path)
+            return
+
+        size = os.path.getsize(self.path)
+        if size < self.size:
+            # Changed by someone else, start over
+            self.__init__(self.path)
+
+        with open(self.path, "rb") as done_file:
+            done_file.seek(self.size)
+            offset = self.size
+            for line in done_file:
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    break
+
+                if line.strip():
+                    number = len(self.offsets)
+                    self.offsets.append(offset)
+
+                    # Projects and contexts, found the same way as parse_todotext does
+                    for word in line.rstrip(b"\r\n").split(b" ")[1:]:
+                        if len(word) > 1 and word[:1] in [b"+", b"@"]:
+                            self.tags.setdefault(word, []).append(number)
+
+                offset += len(line)
+
+            self.size = offset
+
+    # Archived tasks with the given +project or @context, or containing the given text, oldest first
+    def lookup(self, term):
+        self.update()
+        if not os.path.isfile(self.path):
+            return []
+
+        encoding = locale.getpreferredencoding(False)
+        term = term.encode(encoding)
+
+        if len(term) > 1 and term[:1] in [b"+", b"@"]:
+            lines = []
+            if self.tags.get(term):
+                with open(self.path, "rb") as done_file:
+                    for number in self.tags[term]:
+                        done_file.seek(self.offsets[number])
+                        lines.append(done_file.readline())
+
+        else:
+            lines = lines_containing(self.path, [term])
+
+        return [LocalTodo(line.decode(encoding).rstrip("\r\n")) for line in lines if line.strip()]
+
+# Move done tasks to the done.txt next to their file if the archive option is on. With archive-days, only tasks
+# completed at least that many days ago are moved. The tasks are written to done.txt before todo.txt is saved without
+# them, so a crash in between leaves a task in both files rather than in neither.
+def archive_done_todos(todos, index):
+    if not options.get("archive"):
+        return []
+
+    cutoff = datetime.date.today() - datetime.timedelta(days = options.get("archive-days", 0))
+    done = [t for t in index.tasks("done") if not t.completed or t.completed <= cutoff]
+    if done:
+        for origin in todo_files:
+            archived = [t for t in done if t.origin is origin]
+            if archived:
+                origin.archive.append(archived)
+        todos.remove_all(done)
+        count("tasks archived", len(done))
+
+    return done
+
+# The paths of todo.txt and the other files of the workspace, each once
+def workspace_paths():
+    paths = []
+    for path in [options["todo.txt-location"]] + options.get("workspace", []):
+        if os.path.realpath(path) not in [os.path.realpath(p) for p in paths]:
+            paths.append(path)
+
+    return paths
+
+# Read the tasks of all files, in the order of todo_files. The files of a workspace are read and parsed in threads,
+# so one file is parsed while others are still being read.
+@timed("load")
+def load_todos():
+    if len(todo_files) == 1:
+        todos = todo_file.load(snapshot_cache)
+
+    else:
+        # Read the cache once, before the threads use it
+        if snapshot_cache is not None:
+            snapshot_cache.read()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(todo_files)) as pool:
+            todos = list(itertools.chain.from_iterable(pool.map(lambda f: f.load(snapshot_cache), todo_files)))
+
+    count("tasks loaded", len(todos))
+    return todos
+
+# Save the files that have changes, each with only its own tasks
+@timed("save")
+def save_todos(local_todos):
+    saved = False
+    for origin in todo_files:
+        if origin.pending or local_todos.count(origin) != origin.stored_count:
+            saved = origin.save(local_todos.of(origin)) or saved
+
+    return saved
+
+# A filter query, parsed once into a predicate on tasks. Terms are
+#   +project, @context, state:STATE       looked up in the TodoIndex
+#   pri:A, pri:A-C                        priority, or range of priorities
+#   due:DATE, due:FROM..TO, due:..TO      due date or range of them, where a date can also be "today"
+#   key:value, key:*                      addon with this value, or with any value
+#   word                                  text containing word, ignoring case
+# combined with not, and, or and parentheses. Terms next to each other must all match.
+#
+# match(todo) tells whether a task matches. select(index) gives the set of open tasks that match using the index,
+# or None if the query can't be answered from it. Every part of the query has the same pair of functions.
+class Query:
+    def __init__(self, text, today):
+        self.text = text
+        self.today = today
+        self.tokens = re.findall(r"[()]|!(?=\S)|[^\s()]+", text)
+        self.pos = 0
+
+        if not self.tokens:
+            raise ValueError("empty query")
+
+        (self.match, self.select) = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError("unexpected " + self.tokens[self.pos])
+
+    # Open tasks in index that match
+    def tasks(self, index):
+        selected = self.select(index)
+        if selected is None:
+            match = self.match
+            selected = {t for t in index.open_tasks() if match(t)}
+
+        return selected
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def parse_or(self):
+        parts = [self.parse_and()]
+        while self.peek() is not None and self.peek().lower() == "or":
+            self.pos += 1
+            parts.append(self.parse_and())
+
+        if len(parts) == 1:
+            return parts[0]
+
+        matches = [m for (m, s) in parts]
+        selects = [s for (m, s) in parts]
+
+        def match(todo):
+            for m in matches:
+                if m(todo):
+                    return True
+            return False
+
+        # Only when every alternative can be looked up
+        def select(index):
+            sets = []
+            for s in selects:
+                found = s(index)
+                if found is None:
+                    return None
+                sets.append(found)
+            return set().union(*sets)
+
+        return (match, select)
+
+    def parse_and(self):
+        parts = [self.parse_not()]
+        while self.peek() is not None and self.peek() != ")" and self.peek().lower() != "or":
+            if self.peek().lower() == "and":
+                self.pos += 1
+            parts.append(self.parse_not())
+
+        if len(parts) == 1:
+            return parts[0]
+
+        matches = [m for (m, s) in parts]
+        selects = [s for (m, s) in parts]
+
+        def match(todo):
+            for m in matches:
+                if not m(todo):
+                    return False
+            return True
+
+        # Start from the smallest set the index has for any of the parts, narrow it down with the other sets, and
+        # only check the parts that can't be looked up on what is left
+        def select(index):
+            sets = []
+            rest = []
+            for i in range(len(parts)):
+                found = selects[i](index)
+                if found is None:
+                    rest.append(matches[i])
+                else:
+                    sets.append(found)
+
+            if not sets:
+                return None
+
+            sets.sort(key = len)
+            selected = sets[0]
+            for found in sets[1:]:
+                selected = selected.intersection(found)
+
+            for m in rest:
+                selected = {t for t in selected if m(t)}
+
+            return selected
+
+        return (match, select)
+
+    def parse_not(self):
+        if self.peek() is not None and (self.peek().lower() == "not" or self.peek() == "!"):
+            self.pos += 1
+            (m, s) = self.parse_not()
+            return (lambda todo: not m(todo), lambda index: None)
+
+        return self.parse_atom()
 
+    def parse_atom(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("query ends too early")
+        self.pos += 1
+
+        if token == "(":
+            part = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("missing )")
+            self.pos += 1
+            return part
+
+        if token == ")" or token.lower() in ["and", "or"]:
+            raise ValueError("unexpected " + token)
+
+        return self.parse_term(token)
+
+    def parse_term(self, token):
+        if len(token) > 1 and token[0] == "+":
+            return (lambda todo: token in todo.projects, lambda index: index.project_tasks(token))
+
+        if len(token) > 1 and token[0] == "@":
+            return (lambda todo: token in todo.contexts, lambda index: index.context_tasks(token))
+
+        (key, colon, value) = token.partition(":")
+        if not colon or not key or not value:
+            word = token.lower()
+            return (lambda todo: word in todo.text.lower(), lambda index: None)
+
+        if key == "state":
+            if value == "done":
+                return (lambda todo: todo.done, lambda index: index.state_tasks("done"))
+            return (lambda todo: not todo.done and todo.addons.get("state") == value,
+                    lambda index: index.state_tasks(value))
+
+        if key == "pri":
+            (low, dash, high) = value.upper().partition("-")
+            if not dash:
+                high = low
+            if not (len(low) == 1 and len(high) == 1 and low in string.ascii_uppercase and
+                    high in string.ascii_uppercase):
+                raise ValueError("priority must be a letter or range of letters: " + value)
+
+            return (lambda todo: todo.priority and low <= todo.priority[1] <= high, lambda index: None)
+
+        if key == "due":
+            (start, dots, end) = value.partition("..")
+            if not dots:
+                end = start
+            start = self.parse_date(start, datetime.date.min)
+            end = self.parse_date(end, datetime.date.max)
+
+            def match(todo):
+                due = todo.addons.get("due")
+                return due is not None and start <= due <= end
+
+            return (match, lambda index: None)
+
+        if value == "*":
+            return (lambda todo: key in todo.addons, lambda index: None)
+
+        return (lambda todo: todo.addons.get(key) == value, lambda index: None)
+
+    # Date in a due: term, default if left out
+    def parse_date(self, text, default):
+        if not text:
+            return default
+        if text.lower() == "today":
+            return self.today
+
+        try:
+            return parse_date(text)
+        except ValueError:
+            raise ValueError("not a date: " + text)
+
+# Queries are parsed once and kept, for the day they were made for
+@functools.lru_cache(maxsize = 64)
+def compile_query(text, today):
+    return Query(text, today)
+
+# Query for a filter, the list of queries that all have to match
+def filter_query(filter):
+    return compile_query(" and ".join("(" + f + ")" for f in filter), datetime.date.today())
+
+def filter_match(task, filter):
+    if len(filter) == 0:
+        return True
+
+    return filter_query(filter).match(task)
+
+
+# Get string showing numbered, grouped tasks. Returns (str, index_list). With window = (start, count) only that
+# part of the list is shown, numbered as in the whole list. With numbers, a dict of tasks to numbers, tasks are
+# shown with those numbers instead.
+@timed("render")
+def get_interactive_task_list(index, filter = [], window = None, numbers = None):
+    global options
+
+    parts = []
+
+    # Tasks to show, None for all
+    matches = None
+    if len(filter) > 0:
+        matches = filter_query(filter).tasks(index)
+
+    shown = matches
+    if options["filter-color"]:
+        shown = None
+
+    next = index.tasks("next", shown)
+    today = index.tasks("today", shown)
+    scheduled = index.scheduled_tasks(shown)
+    waiting = index.tasks("waiting", shown)
+    someday = index.tasks("someday", shown)
+    new = index.tasks("new", shown)
+    other = index.tasks(None, shown)
+
+    for state in index.other_states():
+        for task in index.tasks(state, shown):
+            parts.append("Warning: unrecognized state: " + state + "\n")
+            other.append(task)
+
+    index_list = next + today + scheduled + waiting + someday + new + other
 
     states = {0: "Next", 
             len(next): "Today", 
@@ -334,353 +2136,1416 @@ def get_interactive_task_list(tasks, filter = []):
             len(next) + len(today) + len(scheduled) + len(waiting) + len(someday): "New",
             len(next) + len(today) + len(scheduled) + len(waiting) + len(someday) + len(new): "Other"}
 
-    for i in range(len(index_list)):
+    start = 0
+    end = len(index_list)
+    if window:
+        # Past the end shows the last page
+        start = min(window[0], max(end - 1, 0) // window[1] * window[1])
+        end = min(start + window[1], end)
+
+        # Show which group the window starts in
+        if index_list and start not in states:
+            parts.append("\n" + states[max(i for i in states if i <= start)] + " (continued)\n")
+
+    highlight = "filter-color" in options and options["filter-color"] and len(filter) > 0
+
+    for i in range(start, end):
         if i in states:
-            return_string += "\n" + states[i] + "\n"
+            parts.append("\n" + states[i] + "\n")
 
-        if index_list[i].addons["state"] == "scheduled":
-            if ("filter-color" in options and options["filter-color"] and 
-                    filter_match(index_list[i], filter) and len(filter) > 0):
-                return_string += (str(i).zfill(2) + ": (" + index_list[i].addons["due"].isoformat() + ") " + 
-                        bcolors.GREEN + index_list[i].human_str() + bcolors.ENDC + "\n")
+        task = index_list[i]
+        text = task.human_str()
+        if highlight and task in matches:
+            text = bcolors.GREEN + text + bcolors.ENDC
 
-            else:
-                return_string += (str(i).zfill(2) + ": (" + index_list[i].addons["due"].isoformat() + ") " + 
-                        index_list[i].human_str() + "\n")
+        if task.addons.get("state") == "scheduled":
+            text = "(" + task.addons["due"].isoformat() + ") " + text
 
-        else:
-            if ("filter-color" in options and options["filter-color"] and 
-                    filter_match(index_list[i], filter) and len(filter) > 0):
-                return_string += (str(i).zfill(2) + ": " + bcolors.GREEN + index_list[i].human_str() + 
-                        bcolors.ENDC + "\n")
+        number = i
+        if numbers is not None:
+            number = numbers[task]
 
-            else:
-                return_string += str(i).zfill(2) + ": " + index_list[i].human_str() + "\n"
+        parts.append(str(number).zfill(2) + ": " + text + "\n")
+
+    count("tasks shown", end - start)
+
+    return ("".join(parts), index_list)
+
+# Number of tasks on a page when paging, leaving room for headers and the prompt
+def get_page_size():
+    return max(shutil.get_terminal_size().lines - 12, 5)
 
-    return (return_string, index_list)
+# The (start, length) of the tasks on the current page for get_interactive_task_list, or None when not paging
+def page_window():
+    if page is None:
+        return None
+    return (page * get_page_size(), get_page_size())
+
+# Remember the parsed tasks of each file for the next start
+def save_snapshots():
+    for origin in todo_files:
+        origin.save_snapshot(snapshot_cache, local_todos)
+
+# Bring the files up to date with their journals, first reading any changes made elsewhere
+def compact_todos():
+    if all(f.journal is None for f in todo_files):
+        return
+
+    reload_todos()
+    save_todos(local_todos)
+    for origin in todo_files:
+        origin.compact(local_todos.of(origin))
+
+# Read the files that were changed elsewhere again, merged with the changes made here. Only lines that changed are
+# parsed again, and files that didn't change aren't read at all. Returns (added, removed, conflicts) like
+# TodoFile.reload for all of them together, or None if no file changed.
+def reload_todos():
+    changed = [f for f in todo_files if f.modified_externally()]
+    if not changed:
+        return None
+
+    # Changes made elsewhere aren't undone
+    if todo_history is not None:
+        todo_history.commit()
+
+    added = []
+    removed = []
+    conflicts = []
+    for origin in changed:
+        (file_added, file_removed, file_conflicts) = origin.reload(local_todos)
+        for todo in file_removed:
+            local_todos.remove(todo)
+
+        added += file_added
+        removed += file_removed
+        conflicts += file_conflicts
+
+    do_auto_actions(added)
+    for todo in added:
+        local_todos.add(todo)
+    todo_scheduler.promote()
+
+    save_todos(local_todos)
+
+    # Changes in the journal that no longer fit the file have been merged, write it all out instead of keeping them
+    for origin in changed:
+        if origin.journal is not None and origin.journal.unapplied:
+            origin.compact(local_todos.of(origin))
+
+    if todo_history is not None:
+        todo_history.discard()
+
+    return (added, removed, conflicts)
 
 # Used to check if todo.txt has changed while entering commands
-def interactive_check_todo_changes(signum, frame):
-    global local_todos, todo_last_modified, todo_externally_changed
-    if os.path.getmtime(options["todo.txt-location"]) > todo_last_modified:
+def interactive_check_todo_changes():
+    global todo_externally_changed
+    if any(f.modified_externally() for f in todo_files):
         todo_externally_changed = True
         print("WARNING: todo.txt has been modified from another application. Reloading...")
-        local_todos = do_auto_actions(load_todos())
-        save_todos(local_todos)
-        (s, l) = get_interactive_task_list(local_todos, filter)
+        (added, removed, conflicts) = reload_todos()
+        for conflict in conflicts:
+            print(conflict)
+        (s, l) = get_interactive_task_list(todo_index, filter, page_window())
         print(s)
         print("Todos reloaded.")
-        todo_last_modified = time.time()
+        print("> ", end = "", flush = True)
+        return True
+
+    return False
+
+# Runs in the background in interactive mode, moving tasks that become due to today when the date changes. Like
+# watch_todo_changes, it only does so while the main thread waits for input.
+def promote_at_rollover():
+    global todo_externally_changed
+    day = datetime.date.today()
+
+    while True:
+        # Sleep until just after midnight, but wake up now and then in case the clock is changed
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days = 1), datetime.time())
+        time.sleep(min((midnight - now).total_seconds() + 0.1, 60))
+
+        if datetime.date.today() == day:
+            continue
+
+        day = datetime.date.today()
+        with todo_lock:
+            if todo_scheduler.promote(day):
+                # Task numbers change, like when todo.txt is changed elsewhere
+                todo_externally_changed = True
+                save_todos(local_todos)
+                (s, l) = get_interactive_task_list(todo_index, filter)
+                print(s)
+                print("Tasks due today moved to today.")
+                print("> ", end = "", flush = True)
+
+# Runs in the background in interactive mode, one for each file. Changes are only handled while the main thread
+# waits for input, it holds todo_lock otherwise.
+def watch_todo_changes(watcher):
+    while True:
+        watcher.wait()
+        with todo_lock:
+            if interactive_check_todo_changes():
+                watcher.reset()
+
+# Generates the lines of a file that contain any of markers, in order. The file is mapped into memory and searched
+# for the markers, so lines without them are never looked at one by one.
+def lines_containing(path, markers):
+    with open(path, "rb") as todo_file:
+        if os.fstat(todo_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(todo_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            # Next match of each marker
+            found = [data.find(m) for m in markers]
+
+            while True:
+                pos = min([f for f in found if f >= 0], default = -1)
+                if pos < 0:
+                    return
+
+                start = data.rfind(b"\n", 0, pos) + 1
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    end = len(data)
+
+                yield data[start:end]
+
+                # Continue after this line
+                for i in range(len(markers)):
+                    if 0 <= found[i] < end:
+                        found[i] = data.find(markers[i], end)
+
+# Print the tasks marked next and today in the files at paths. Each file is read line by line and only lines that
+# can be next or today are parsed. Scheduled and waiting tasks due by today count as today, as DueScheduler would
+# make them. Nothing is written.
+@timed("summary")
+def print_summary(paths):
+    next_todos = []
+    today_todos = []
+    today = datetime.date.today()
+    encoding = locale.getpreferredencoding(False)
+    markers = [b"state:next", b"state:today", b"due:"]
+
+    for path in paths:
+        lines = (line.decode(encoding) for line in lines_containing(path, markers))
+
+        # Changes in the journal have to be played over the whole file first
+        journal = Journal(journal_path(path))
+        if journal.read():
+            with open(path, "r") as todo_file:
+                lines = [line for line in TodoFile(path, journal = True).lines(todo_file.readlines())
+                        if any(m.decode() in line for m in markers)]
+
+        for line in lines:
+            todo = LocalTodo(line.rstrip("\r\n"))
+            if todo.done:
+                continue
+
+            state = todo.addons.get("state")
+            if state in ["scheduled", "waiting"] and "due" in todo.addons and todo.addons["due"] <= today:
+                state = "today"
+
+            if state == "next":
+                next_todos.append(todo)
+            elif state == "today":
+                today_todos.append(todo)
+
+    summary = format_summary(next_todos, today_todos)
+    if summary:
+        print(summary)
 
+def format_summary(next_todos, today_todos):
+    lines = []
+    if len(next_todos) > 0:
+        lines.append("Next:")
+        for t in next_todos:
+            lines.append(t.human_str())
+
+    if len(today_todos) > 0:
+        lines.append("Today:")
+        for t in today_todos:
+            lines.append(t.human_str())
+
+    return "\n".join(lines)
+
+# Columns of all tasks for --report, filled in one pass over the lines without making LocalTodo objects. Dates are
+# ordinals, 0 where there is none. States and tags are codes, indexes into the lists of their names. A task can
+# have any number of projects and contexts, so those are kept as pairs of task number and tag code.
+class TaskColumns:
+    def __init__(self):
+        self.created = array.array("i")
+        self.completed = array.array("i")
+        self.due = array.array("i")
+        self.done = array.array("b")
+        self.archived = array.array("b")
+        self.state = array.array("i")
+        self.tag_task = array.array("i")
+        self.tag_code = array.array("i")
+        # Names in the order they were first seen, and the code of each
+        self.states = []
+        self.state_codes = {}
+        self.tags = []
+        self.tag_codes = {}
+
+    def __len__(self):
+        return len(self.done)
+
+    # Add the tasks of lines. Open tasks without a state are new, as the automatic actions would make them.
+    def add_lines(self, lines, archived = False):
+        for line in lines:
+            line = line.rstrip("\r\n")
+            result = todo_head_regex.match(line)
+            if not line.strip() or not result:
+                continue
+
+            (complete_date, created_date, complete_text, priority, incomplete_created,
+                    incomplete_text) = result.groups()
+            if complete_text is not None:
+                self.done.append(1)
+                self.completed.append(date_ordinal(complete_date))
+                self.created.append(date_ordinal(created_date))
+                text = complete_text
+                state = "done"
+
+            else:
+                self.done.append(0)
+                self.completed.append(0)
+                self.created.append(date_ordinal(incomplete_created))
+                text = incomplete_text
+                state = "new"
+
+            due = 0
+            number = len(self.done) - 1
+            for word in report_word_regex.findall(text):
+                if word[0] == "+" or word[0] == "@":
+                    code = self.tag_codes.get(word)
+                    if code is None:
+                        code = self.tag_codes[word] = len(self.tags)
+                        self.tags.append(word)
+                    self.tag_task.append(number)
+                    self.tag_code.append(code)
+
+                elif word[0] == "s":
+                    if complete_text is None:
+                        state = word[6:]
+
+                else:
+                    due = date_ordinal(word[4:])
+
+            code = self.state_codes.get(state)
+            if code is None:
+                code = self.state_codes[state] = len(self.states)
+                self.states.append(state)
+
+            self.due.append(due)
+            self.state.append(code)
+            self.archived.append(archived)
+
+# The words of a task's text that --report looks at: projects and contexts, which like in parse_todotext can't be
+# the first word, and state: and due: addons
+report_word_regex = re.compile(r"(?<= )[+@][^ ]+|(?:(?<= )|^)(?:state|due):[^ ]+")
+
+# Ordinal of a YYYY-MM-DD date, with or without a space after it, or 0 if there is none
+@functools.lru_cache(maxsize = 4096)
+def date_ordinal(text):
+    if not text:
+        return 0
+
+    try:
+        return parse_date(text.strip()).toordinal()
+    except ValueError:
+        return 0
+
+# Limits of the buckets ages and times to complete are counted in, in days, and their names
+report_buckets = [1, 7, 30, 91, 365]
+report_bucket_names = ["under a day", "1 day to a week", "1 week to a month", "1 to 3 months", "3 months to a year",
+        "over a year"]
+
+# Weeks of throughput shown
+report_weeks = 12
+
+# Aggregates of columns for format_report. With NumPy each is computed on whole columns at once, without it the
+# array module columns are counted and sorted by the built-in functions.
+def report_values(columns, today):
+    today = today.toordinal()
+    # Start of this week, Monday
+    week = today - datetime.date.fromordinal(today).weekday()
+    buckets = len(report_buckets) + 1
+
+    if numpy is not None:
+        (created, completed, due, done, archived, state, tag_task, tag_code) = [
+                numpy.frombuffer(c, dtype = c.typecode) if len(c) else numpy.zeros(0, c.typecode)
+                for c in (columns.created, columns.completed, columns.due, columns.done, columns.archived,
+                        columns.state, columns.tag_task, columns.tag_code)]
+
+        done = done.astype(bool)
+        unfinished = ~done
+        states = numpy.bincount(state, minlength = len(columns.states)).tolist()
+        tag_done = done[tag_task]
+        tags_open = numpy.bincount(tag_code[~tag_done], minlength = len(columns.tags)).tolist()
+        tags_done = numpy.bincount(tag_code[tag_done], minlength = len(columns.tags)).tolist()
+
+        ages = today - created[unfinished & (created > 0)]
+        latencies = (completed - created)[done & (created > 0) & (completed >= created)]
+        overdue = today - due[unfinished & (due > 0) & (due < today)]
+        weeks_ago = (week - completed[done & (completed > 0)] + 6) // 7
+        weeks_ago = weeks_ago[(weeks_ago >= 0) & (weeks_ago < report_weeks)]
+
+        values = {
+            "open": int(unfinished.sum()),
+            "archived": int(archived.sum()),
+            "undated": int(unfinished.sum()) - len(ages),
+            "ages": numpy.bincount(numpy.searchsorted(report_buckets, ages, side = "right"),
+                    minlength = buckets).tolist(),
+            "latencies": numpy.bincount(numpy.searchsorted(report_buckets, latencies, side = "right"),
+                    minlength = buckets).tolist(),
+            "median latency": int(numpy.partition(latencies, len(latencies) // 2)[len(latencies) // 2])
+                    if len(latencies) else None,
+            "overdue": len(overdue),
+            "overdue week": int((overdue > 7).sum()),
+            "weeks": numpy.bincount(weeks_ago, minlength = report_weeks).tolist(),
+        }
+
+    else:
+        states = [0] * len(columns.states)
+        for (code, n) in collections.Counter(columns.state).items():
+            states[code] = n
+
+        tags_open = [0] * len(columns.tags)
+        tags_done = [0] * len(columns.tags)
+        done = columns.done
+        for ((code, is_done), n) in collections.Counter(zip(columns.tag_code,
+                [done[t] for t in columns.tag_task])).items():
+            (tags_done if is_done else tags_open)[code] = n
+
+        ages = sorted(today - c for (c, d) in zip(columns.created, done) if c and not d)
+        latencies = sorted(f - c for (c, f, d) in zip(columns.created, columns.completed, done) if d and c and f >= c)
+        overdue = sorted(today - due for (due, d) in zip(columns.due, done) if due and not d and due < today)
+        weeks = collections.Counter((week - f + 6) // 7 for (f, d) in zip(columns.completed, done) if d and f)
+
+        values = {
+            "open": len(done) - sum(done),
+            "archived": sum(columns.archived),
+            "undated": len(done) - sum(done) - len(ages),
+            "ages": sorted_buckets(ages),
+            "latencies": sorted_buckets(latencies),
+            "median latency": latencies[len(latencies) // 2] if latencies else None,
+            "overdue": len(overdue),
+            "overdue week": len(overdue) - bisect.bisect_right(overdue, 7),
+            "weeks": [weeks.get(i, 0) for i in range(report_weeks)],
+        }
+
+    values["total"] = len(columns)
+    values["states"] = sorted(zip(columns.states, states), key = lambda x: -x[1])
+    values["tags"] = sorted(zip(columns.tags, tags_open, tags_done), key = lambda x: (-x[1], -x[2], x[0]))
+    values["week"] = datetime.date.fromordinal(week)
+
+    return values
+
+# Number of sorted values in each of report_buckets
+def sorted_buckets(values):
+    edges = [0] + [bisect.bisect_left(values, limit) for limit in report_buckets] + [len(values)]
+    return [edges[i + 1] - edges[i] for i in range(len(edges) - 1)]
+
+def format_report(values):
+    lines = ["Tasks: " + str(values["total"]) + ", " + str(values["open"]) + " open, " +
+            str(values["total"] - values["open"]) + " done, " + str(values["archived"]) + " of them archived"]
+
+    lines.append("")
+    lines.append("%-20s %8s" % ("State", "Tasks"))
+    for (state, n) in values["states"]:
+        lines.append("%-20s %8d" % (state, n))
+
+    # The projects and contexts with the most open tasks
+    lines.append("")
+    lines.append("%-20s %8s %8s" % ("Project/context", "Open", "Done"))
+    for (tag, n_open, n_done) in values["tags"][:20]:
+        lines.append("%-20s %8d %8d" % (tag, n_open, n_done))
+    if len(values["tags"]) > 20:
+        lines.append("and " + str(len(values["tags"]) - 20) + " more")
+
+    lines.append("")
+    lines.append("Age of open tasks")
+    for (name, n) in zip(report_bucket_names, values["ages"]):
+        lines.append("  %-20s %8d" % (name, n))
+    lines.append("  %-20s %8d" % ("no creation date", values["undated"]))
+
+    lines.append("")
+    lines.append("Time to complete")
+    for (name, n) in zip(report_bucket_names, values["latencies"]):
+        lines.append("  %-20s %8d" % (name, n))
+    if values["median latency"] is not None:
+        lines.append("  median " + str(values["median latency"]) + " days")
+
+    lines.append("")
+    lines.append("Overdue: " + str(values["overdue"]) + " open tasks, " + str(values["overdue week"]) +
+            " of them by more than a week")
+
+    lines.append("")
+    lines.append("Completed per week")
+    for (i, n) in enumerate(values["weeks"]):
+        lines.append("  week of " + (values["week"] - datetime.timedelta(weeks = i)).isoformat() + " %8d" % n)
+
+    return "\n".join(lines)
+
+# Print the report for the files at paths and the done.txt next to each of them. Nothing is written.
+@timed("report")
+def print_report(paths):
+    columns = TaskColumns()
+    archives = []
+    for path in paths:
+        with open(path, "r") as todo_file:
+            lines = todo_file
+            if Journal(journal_path(path)).read():
+                lines = TodoFile(path, journal = True).lines(todo_file.readlines())
+            columns.add_lines(lines)
+
+        archive = os.path.join(os.path.dirname(os.path.abspath(path)), "done.txt")
+        if archive not in archives and os.path.isfile(archive):
+            archives.append(archive)
+
+    for archive in archives:
+        with open(archive, "r") as done_file:
+            columns.add_lines(done_file, archived = True)
+
+    count("tasks reported", len(columns))
+    print(format_report(report_values(columns, datetime.date.today())))
+
+@timed("auto actions")
 def do_auto_actions(todos):
+    count("tasks checked", len(todos))
+    today = datetime.date.today()
     for todo in todos:
+        # Finished tasks are left as they are, without parsing them
+        if not todo.parsed and done_line_settled(todo.raw):
+            continue
+
         # Tag new tasks as new
         if not "state" in todo.addons and not todo.done:
             todo.addons["state"] = "new"
 
         # Complete tasks should be tagged as such
-        if todo.done:
+        if todo.done and todo.addons.get("state") != "done":
             todo.addons["state"] = "done"
 
         # Set creation date for undated tasks
         if not todo.created and not todo.done:
-            todo.created = datetime.date.today()
-
-        # Make scheduled tasks due today or earlier have state today
-        if ((todo.addons["state"] == "scheduled" or todo.addons["state"] == "waiting") and "due" in todo.addons and 
-                todo.addons["due"] <= datetime.date.today()):
-            todo.addons["state"] = "today"
+            todo.created = today
 
+    # Scheduled and waiting tasks due today or earlier are moved to today by DueScheduler
     return todos
 
-# Load options
-if os.path.isfile(data_file):
-    options = load_options(data_file)
+# Called when a task is about to be marked done. A recurring task gets its next instance right away, scheduled for
+# when it is due, in the same file. DueScheduler moves it to today when that day comes, so recurring tasks cost
+# nothing on load. Returns the new task, or None.
+def recur_todo(todo):
+    rec = parse_recurrence(str(todo.addons.get("rec", "")))
+    if todo.done or rec is None:
+        return None
+
+    today = datetime.date.today()
+    instance = LocalTodo(todo.line())
+    instance.created = today
+    instance.addons["due"] = rec.next_due(todo.addons.get("due"), today)
+    instance.addons["state"] = "scheduled"
+    # It is a task of its own on Habitica
+    instance.addons.pop("habitica_id", None)
+
+    (todo.origin or todo_file).add(instance)
+    local_todos.add(instance)
+    count("tasks recurred", 1)
+
+    return instance
+
+# Run one of the commands shared by interactive and batch mode on tasks, where tasks[N] is the task numbered N.
+# Returns (ok, message). Only in interactive mode is the user asked for anything missing.
+def run_command(cmd, tasks, interactive = True):
+    if cmd[0].lower() == "add":
+        new_task_str = " ".join(cmd[1:])
+        if len(new_task_str) < 1:
+            return (False, "Please specify todo")
+
+        new_task = LocalTodo(new_task_str)
+        new_task.addons["state"] = "new"
+        new_task.created = datetime.date.today()
+
+        todo_file.add(new_task)
+        local_todos.add(new_task)
+
+        if not interactive:
+            tasks.append(new_task)
+            return (True, "Created task " + str(len(tasks) - 1) + " \"" + new_task.text + "\"")
+
+        return (True, "Created task \"" + new_task.text + "\"")
+
+    elif cmd[0].lower() == "filter":
+        query = " ".join(cmd[1:]).strip()
+        if len(query) == 0:
+            return (False, "Please specify filter")
+
+        # -project removes +project, -query removes query
+        if query[0] == "-":
+            for i in range(len(filter)):
+                if filter[i] == query[1:] or filter[i][1:] == query[1:]:
+                    out = "Removed filter " + filter[i]
+                    del filter[i]
+                    return (True, out)
+
+            return (True, "")
 
-else:
-    options = {}
+        try:
+            compile_query(query, datetime.date.today())
+        except ValueError as e:
+            return (False, "Invalid filter: " + str(e))
 
-# Take option input from user
-if not "todo.txt-location" in options:
-    options["todo.txt-location"] = input("todo.txt location: ")
-    options["filter-color"] = False
-    # Make sure the file can be written to
-    open(options["todo.txt-location"], "a").close()
-    save_options(data_file, options)
+        filter.append(query)
+        return (True, "Added filter " + query)
 
+    elif cmd[0].lower() == "history":
+        if len(cmd) == 1:
+            return (False, "Please specify +project, @context or text to look for in done.txt")
 
-# Load todos from todo.txt
-local_todos = load_todos()
+        # Files in the same directory share done.txt
+        archives = {}
+        for origin in todo_files:
+            archives.setdefault(origin.archive.path, origin.archive)
 
-# Perform automated actions
-local_todos = do_auto_actions(local_todos)
+        found = []
+        for archive in archives.values():
+            found += archive.lookup(" ".join(cmd[1:]))
+        out = str(len(found)) + " archived tasks found"
+        for todo in found[-20:]:
+            out += "\n" + todo.line().rstrip("\n")
 
-next_todos = []
-today_todos = []
-for todo in local_todos:
-    if todo.addons["state"] == "next":
-        next_todos.append(todo)
+        return (True, out)
 
-    elif todo.addons["state"] == "today":
-        today_todos.append(todo)
+    elif cmd[0].lower() == "option":
+        if len(cmd) != 3:
+            return (False, "Please specity name and value")
 
-# If summary is not set, the tasks will be printed shortly anyways
-if args.summary:
-    # Print upcoming tasks
-    if len(next_todos) > 0:
-        print("Next:")
-        for t in next_todos:
-            print(t.human_str())
+        if cmd[2].lower() == "on":
+            options[cmd[1]] = True
 
-    if len(today_todos) > 0:
-        print("Today:")
-        for t in today_todos:
-            print(t.human_str())
-
-
-if args.guided:
-    if len(next_todos) == 0 and not args.summary:
-        if len(today_todos) > 0:
-            if ask_question("No todos marked as next, go through list for today?") == "Y":
-                for todo in today_todos:
-                    print(todo.human_str())
-                    if ask_question("Mark as next?") == "Y":
-                        set_priority(todo)
-                        todo.addons["state"] = "next"
-                        print("Moved to next")
-
-
-# Do review
-if not args.summary and args.guided:
-    for todo in local_todos:
-        if todo.addons["state"] == "new":
-            print("---")
-            print(todo.human_str())
-
-            r = ask_question("Does it take less than 2 minutes?", {"Y": "Yes", "N": "No", "S": "Skip"})
-            if r == "Y":
-                print("Do it now.")
-                if ask_question("Is it done?") == "Y":
-                    todo.done = True
-                    del todo.addons["state"]
-                    print("Task marked as done")
-                    continue
+        elif cmd[2].lower() == "off":
+            options[cmd[1]] = False
 
-                else:
-                    continue
+        elif cmd[2].isdigit():
+            options[cmd[1]] = int(cmd[2])
 
-            elif r == "S":
-                break
+        else:
+            return (False, "Invalid value")
 
+        save_options(data_file, options)
+        return (True, "")
 
-            add_metadata(todo)
-            r = ask_question("Complete (N)ext, (T)oday, at a certain (D)ate or (S)omeday?", 
-                    {"N": "Next", "T": "Today", "D": "Certain date", "S": "Someday"})
+    elif cmd[0].lower() == "sync":
+        # The server can be given for this sync, to use another than Habitica's own
+        if not options.get("habitica-user") or not options.get("habitica-key"):
+            if not interactive:
+                return (False, "Please sync in interactive mode first to enter your Habitica user ID and API token")
 
-            if r == "N":
-                set_priority(todo)
-                todo.addons["state"] = "next"
-                print("Marked as next")
-                continue
+            options["habitica-user"] = input("Habitica user ID: ").strip()
+            options["habitica-key"] = input("Habitica API token: ").strip()
+            save_options(data_file, options)
 
-            elif r == "T":
-                set_priority(todo)
-                todo.addons["state"] = "today"
-                print("Marked as today")
-                continue
+        try:
+            result = sync_habitica(local_todos, cmd[1] if len(cmd) > 1 else None)
+        except ValueError as e:
+            return (False, "Invalid Habitica URL: " + str(e))
+
+        # Undoing the ids Habitica gave would create the tasks there again
+        if todo_history is not None:
+            todo_history.discard()
+        return result
+
+    elif cmd[0].lower() == "workspace":
+        # Lists the files, or adds or removes one of them. Changes are used from the next start.
+        if len(cmd) == 1:
+            return (True, "\n".join(workspace_paths()))
+
+        path = " ".join(cmd[2:]).strip()
+        if cmd[1].lower() not in ["add", "remove"] or not path:
+            return (False, "Please specify add or remove and a todo.txt path")
+
+        workspace = options.get("workspace", [])
+        if cmd[1].lower() == "add":
+            if path in workspace_paths():
+                return (False, path + " is already in the workspace")
+
+            # Make sure the file can be written to
+            try:
+                open(path, "a").close()
+            except OSError as e:
+                return (False, "Can't use " + path + ": " + e.strerror)
 
-            elif r == "D":
-                while not "due" in todo.addons:
-                    try:
-                        todo.addons["due"] = datetime.datetime.strptime(
-                                input("Enter date (YYYY-MM-DD): ").strip(), "%Y-%m-%d").date().isoformat()
-                    except ValueError:
-                        print("Format not recognized")
-                
-                todo.addons["state"] = "scheduled"
+            options["workspace"] = workspace + [path]
 
-                continue
+        else:
+            if path not in workspace:
+                return (False, path + " is not in the workspace")
 
-            elif r == "S":
-                # Delegate to someday
-                todo.priority = "(Z) "
-                todo.addons["state"] = "someday"
-                print("Task marked as \"someday\"")
-                continue
+            options["workspace"] = [p for p in workspace if p != path]
 
-            # TODO: Implement convert to project
+        save_options(data_file, options)
+        return (True, "Workspace changed, restart to use it")
 
-quit = False
-if not args.summary:
-    # Enter interactive mode
-    out = ""
-    signal.signal(signal.SIGALRM, interactive_check_todo_changes)
-    signal.setitimer(signal.ITIMER_REAL, 1, 1)
+    try:
+        target = int(cmd[0])
+        command = cmd[1]
 
-    while not quit:
-        # Sort & save tasks
-        local_todos.sort(key = lambda x: str(x))
-        save_todos(local_todos)
+    except ValueError:
+        return (False, cmd[0] + " is not a valid task number")
 
-        (s, index_list) = get_interactive_task_list(local_todos, filter)
-        print('\n')
-        print(s)
+    except IndexError:
+        return (False, "Please specify a command")
 
-        if len(filter) != 0:
-            print("Filter: " + ", ".join(filter))
+    if target < 0 or target >= len(tasks) or tasks[target] is None:
+        return (False, cmd[0] + " is not a valid task number")
 
-        if out != "":
-            print(out)
-        print("Q to quit")
+    todo = tasks[target]
+
+    if command == "state":
+        try:
+            new_state = cmd[2]
 
+        except IndexError:
+            return (False, "Please specify new state")
+
+        if new_state in ["new", "next", "today", "waiting", "new", "someday"]:
+            todo.addons["state"] = new_state
+            return (True, "Set state of " + todo.text + " to " + new_state)
+
+        elif new_state == "scheduled":
+            # The date can be given after the state, otherwise it is asked for
+            due = None
+            if len(cmd) > 3:
+                try:
+                    due = datetime.datetime.strptime(cmd[3].strip(), "%Y-%m-%d").date()
+                except ValueError:
+                    return (False, "Format not recognized: " + cmd[3])
+
+            elif not interactive:
+                return (False, "Please specify date (YYYY-MM-DD)")
+
+            if "due" in todo.addons:
+                del todo.addons["due"]
+
+            if due is None:
+                os.system("cal -3")
+
+            while due is None:
+                try:
+                    due = datetime.datetime.strptime(input("Enter date (YYYY-MM-DD): ").strip(), "%Y-%m-%d").date()
+                except ValueError:
+                    print("Format not recognized")
+
+            todo.addons["due"] = due
+            todo.addons["state"] = new_state
+            return (True, "Scheduled " + todo.text + " for " + todo.addons["due"].isoformat())
+
+        else:
+            return (False, "Unrecognized state: " + new_state)
+
+    elif command == "pri":
         try:
-            inp = input("> ")
+            new_pri = cmd[2]
+
+        except IndexError:
+            return (False, "Please specify new priority")
+
+        if len(new_pri) == 1 and new_pri.upper() in string.ascii_uppercase:
+            todo.priority = "(" + new_pri.upper() + ") "
+            return (True, "Set priority of " + todo.text + " to " + todo.priority)
+
+        else:
+            return (False, "Please specify a single-letter priority")
+
+    elif command == "done":
+        instance = recur_todo(todo)
+        todo.done = True
+        todo.addons["state"] = "done"
+        todo.completed = datetime.date.today()
+        if instance is None:
+            return (True, "Marked " + todo.text + " as done.")
 
-        except KeyboardInterrupt:
-            quit = True
+        if not interactive:
+            tasks.append(instance)
+        return (True, "Marked " + todo.text + " as done. Next one is due " + instance.addons["due"].isoformat())
+
+    else:
+        return (False, "Unknown command: " + cmd[1])
+
+# Run the commands in lines, one per line, on tasks numbered by their place in todo.txt as it was read. Empty lines
+# and lines starting with # are skipped, q stops. Tasks are saved once, after the last command. Returns the
+# number of commands that failed.
+def run_batch(lines, loaded):
+    tasks = [None] + loaded
+    pending = sum(len(f.pending) for f in todo_files)
+    ran = 0
+    failed = 0
+
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
             continue
 
-        # If todo.txt is modified by another program, make sure we have correct task list numbers
-        if todo_externally_changed:
-            (s, index_list) = get_interactive_task_list(local_todos, filter)
-            todo_externally_changed = False
+        if line == "q" or line == "Q":
+            break
 
-        cmd = inp.split(" ")
+        (ok, out) = run_command(line.split(" "), tasks, interactive = False)
+        ran += 1
+        if not ok:
+            failed += 1
+            print("Line " + str(number) + ": " + out)
 
-        if cmd[0] == "q" or cmd[0] == "Q":
-            quit = True
+        elif out:
+            print(out)
 
-        elif cmd[0].lower() == "add":
-            new_task_str = " ".join(cmd[1:])
-            if len(new_task_str) < 1:
-                out = "Please specify todo"
-                continue
+    todo_scheduler.promote()
+    archive_done_todos(local_todos, todo_index)
+    changed = sum(len(f.pending) for f in todo_files) - pending
+    save_todos(local_todos)
 
-            new_task = LocalTodo(new_task_str)
-            new_task.addons["state"] = "new"
-            new_task.created = datetime.date.today()
+    print(str(ran) + " commands, " + str(failed) + " failed, " + str(changed) + " tasks changed or added")
+    return failed
 
-            local_todos.append(new_task)
+# Path of the daemon's socket
+def daemon_socket_path():
+    return data_file + ".sock"
 
-            out = "Created task \"" + new_task.text + "\""
+# Answer one command sent to the daemon, returns (ok, output). Anything that changes tasks is saved right away.
+def daemon_command(text, numbers):
+    reloaded = reload_todos()
+    if reloaded:
+        (added, removed, conflicts) = reloaded
+        for todo in removed:
+            numbers.remove(todo)
+        for todo in added:
+            numbers.append(todo)
 
-        elif cmd[0].lower() == "filter":
-            if len(cmd) == 1:
-                out = "Please specify filter"
-                continue
+    cmd = text.strip().split(" ")
+    todo_scheduler.promote()
 
-            if len(cmd) > 2:
-                out = "Too many arguments for filter"
-                continue
+    if cmd[0] == "summary":
+        return (True, format_summary(todo_index.tasks("next"), todo_index.tasks("today")))
 
-            if cmd[1][0] == "-":
-                for i in range(len(filter)):
-                    if filter[i][1:] == cmd[1][1:]:
-                        del filter[i]
-                        out = "Removed filter " + cmd[1][1:]
-                        break
+    if cmd[0] == "list":
+        query = " ".join(cmd[1:]).strip()
+        try:
+            (s, index_list) = get_interactive_task_list(todo_index, [query] if query else [], numbers = numbers.numbers)
+        except ValueError as e:
+            return (False, "Invalid filter: " + str(e))
 
-            else:
-                filter.append(cmd[1].strip())
-                out = "Added filter " + cmd[1]
+        return (True, s.strip("\n"))
 
-        elif cmd[0].lower() == "option":
-            if len(cmd) != 3:
-                out = "Please specity name and value"
-                continue
+    # Filters would be shared by all clients and list doesn't use them, it takes a query instead
+    if cmd[0].lower() == "filter":
+        return (False, "filter isn't kept in the daemon, use list QUERY instead")
 
-            if cmd[2].lower() == "on":
-                options[cmd[1]] = True
+    (ok, out) = run_command(cmd, numbers, interactive = False)
+    # Archived tasks are gone, their numbers aren't given to any other task
+    for todo in archive_done_todos(local_todos, todo_index):
+        numbers.remove(todo)
+    save_todos(local_todos)
+    return (ok, out)
 
-            elif cmd[2].lower() == "off":
-                options[cmd[1]] = False
+# A client connection to the daemon. Each line from the client is a JSON object {"command": text}, answered with a
+# line {"ok": bool, "output": text}. Commands from all clients, and reloads, take turns through todo_lock.
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                text = json.loads(line.decode("utf-8"))["command"]
+                if not isinstance(text, str):
+                    raise TypeError("command is not a string")
+            except (ValueError, KeyError, TypeError):
+                reply = {"ok": False, "output": "Invalid request"}
 
             else:
-                out = "Invalid value"
-                continue
+                with todo_lock:
+                    # A failing command is answered, and the daemon goes on serving
+                    try:
+                        (ok, out) = daemon_command(text, self.server.numbers)
+                    except Exception as e:
+                        print("Command " + json.dumps(text) + " failed: " + repr(e))
+                        (ok, out) = (False, "Command failed: " + str(e))
+                    if stats is not None:
+                        stats.end_command(args.stats_out)
+                reply = {"ok": ok, "output": out}
+
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Serve commands on the daemon socket until interrupted
+def run_daemon(loaded):
+    global todo_lock
+    path = daemon_socket_path()
+
+    # A socket left behind by a daemon that is gone is replaced, one that answers is left alone
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            print("A daemon is already running on " + path)
+            return False
 
-            save_options(data_file, options)
+        except OSError:
+            os.unlink(path)
 
+    todo_lock = threading.Lock()
+    save_todos(local_todos)
 
-        else:
+    # Only the user may connect
+    umask = os.umask(0o077)
+    try:
+        server = DaemonServer(path, DaemonHandler)
+    finally:
+        os.umask(umask)
+
+    server.numbers = TaskNumbers(loaded)
+
+    # Changes to the files are read right away, so summaries stay up to date without anyone sending commands
+    def watch(watcher):
+        while True:
+            watcher.wait()
+            with todo_lock:
+                reloaded = reload_todos()
+                if reloaded:
+                    watcher.reset()
+                    for conflict in reloaded[2]:
+                        print(conflict)
+                    for todo in reloaded[1]:
+                        server.numbers.remove(todo)
+                    for todo in reloaded[0]:
+                        server.numbers.append(todo)
+
+    for origin in todo_files:
+        threading.Thread(target = watch, args = (FileWatcher(origin.path),), daemon = True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("Serving on " + path)
+    try:
+        server.serve_forever()
+    # SIGTERM exits through SystemExit, the tasks are still saved below
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+    with todo_lock:
+        save_todos(local_todos)
+        compact_todos()
+    return True
+
+# Run commands in the daemon and print what it answers. Returns the number of commands that failed.
+def send_commands(commands):
+    failed = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(daemon_socket_path())
+        stream = connection.makefile("rwb")
+
+        for (i, command) in enumerate(commands):
+            stream.write(json.dumps({"command": command}).encode("utf-8") + b"\n")
+            stream.flush()
+            line = stream.readline()
+            if not line:
+                print("The daemon closed the connection without answering " + command)
+                # This command and the ones after it failed
+                return failed + len(commands) - i
+
+            reply = json.loads(line.decode("utf-8"))
+            if not reply["ok"]:
+                failed += 1
+            if reply["output"]:
+                print(reply["output"])
+
+    return failed
+
+# Habitica API server used by sync, with the API version
+habitica_url = "https://habitica.com"
+
+# Tasks created by one request, and requests sent at once, unless the habitica-connections option says otherwise
+habitica_batch = 50
+habitica_connections = 4
+
+# Content hash of a task, taken from its todo.txt line so that unchanged tasks aren't parsed
+def habitica_hash(todo):
+    return hashlib.blake2b(todo.line().encode("utf-8"), digest_size = 8).digest()
+
+# A pool of keep-alive connections to the Habitica API. Requests are sent from a thread per connection, asyncio
+# callers wait for a free connection, so no more than connections requests are ever in flight.
+class HabiticaClient:
+    def __init__(self, url, user, key, connections):
+        parts = urllib.parse.urlsplit(url)
+        self.base = parts.path.rstrip("/") + "/api/v3"
+        self.headers = {"x-api-user": user, "x-api-key": key, "x-client": user + "-toadmin.txt",
+                "Content-Type": "application/json"}
+
+        connection_class = http.client.HTTPConnection
+        if parts.scheme == "https":
+            connection_class = http.client.HTTPSConnection
+
+        # Connections reconnect by themselves when the server closes them
+        self.idle = asyncio.Queue()
+        for i in range(connections):
+            self.idle.put_nowait(connection_class(parts.hostname, parts.port, timeout = 30))
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = connections)
+        self.requests = 0
+
+    # Send a request and return (ok, data), where data is the data of the reply or the error message
+    async def request(self, method, path, body = None):
+        connection = await self.idle.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.send, connection, method,
+                    path, body)
+        finally:
+            self.idle.put_nowait(connection)
+
+    def send(self, connection, method, path, body):
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+
+        # Retried when the request couldn't be sent, or when the server asks us to slow down. When the connection
+        # breaks after the request was sent, the server may have acted on it already, so only requests that can be
+        # repeated are retried.
+        for attempt in range(3):
+            self.requests += 1
             try:
-                target = int(cmd[0])
-                command = cmd[1]
+                connection.request(method, self.base + path, body = payload, headers = self.headers)
 
-            except ValueError:
-                out = (cmd[0] + " is not a valid task number")
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                error = str(e)
                 continue
 
-            except IndexError:
-                out = ("Please specify a command")
+            try:
+                response = connection.getresponse()
+                data = response.read()
+
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                error = str(e)
+                if method in ["GET", "PUT", "DELETE"]:
+                    continue
+                return (False, error)
+
+            if response.status == 429:
+                error = "Too many requests"
+                time.sleep(float(response.getheader("Retry-After", "1")))
                 continue
 
-            if command == "state":
-                try:
-                    new_state = cmd[2]
+            try:
+                reply = json.loads(data.decode("utf-8"))
+            except ValueError:
+                return (False, "Invalid reply from Habitica, status " + str(response.status))
+
+            if response.status >= 400 or not reply.get("success"):
+                return (False, reply.get("message", "Habitica answered " + str(response.status)))
+
+            return (True, reply.get("data"))
+
+        return (False, error)
+
+    def close(self):
+        self.executor.shutdown()
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+# Send the tasks changed since the last sync to Habitica. Which tasks were synced is kept in the options as the
+# habitica_hash of each, so only tasks whose line changed are looked at. Tasks without a habitica_id addon are
+# created in batches and get the id Habitica gives them, the others are updated, and scored when they were done
+# or undone. Done tasks that were never sent are left out. Tasks that failed are tried again on the next sync.
+# Returns (ok, message).
+def sync_habitica(todos, url = None):
+    synced = options.get("habitica-synced", set())
+    completed = options.get("habitica-completed", set())
+    todos = list(todos)
+    hashes = [habitica_hash(t) for t in todos]
+    changed = [t for (t, h) in zip(todos, hashes) if h not in synced]
+
+    create = []
+    update = []
+    score = []
+    for todo in changed:
+        if "habitica_id" not in todo.addons:
+            if not todo.done:
+                create.append(todo)
+            continue
 
-                except IndexError:
-                    out = ("Please specify new state")
-                    continue
+        update.append(todo)
+        if todo.done != (todo.addons["habitica_id"] in completed):
+            score.append(todo)
+
+    client = HabiticaClient(url or options.get("habitica-url", habitica_url), options["habitica-user"],
+            options["habitica-key"], options.get("habitica-connections", habitica_connections))
+    failed = set()
+    errors = []
+
+    async def create_batch(batch):
+        (ok, data) = await client.request("POST", "/tasks/user", [t.get_dict() for t in batch])
+        # One task is answered with an object, several with a list
+        if ok and isinstance(data, dict):
+            data = [data]
+
+        if not ok or len(data) != len(batch):
+            failed.update(batch)
+            errors.append(str(data))
+            return
+
+        for (todo, task) in zip(batch, data):
+            todo.addons["habitica_id"] = task["id"]
+
+    async def update_task(todo):
+        body = todo.get_dict()
+        del body["id"]
+        (ok, data) = await client.request("PUT", "/tasks/" + todo.addons["habitica_id"], body)
+        if not ok:
+            failed.add(todo)
+            errors.append(data)
+
+    async def score_task(todo):
+        direction = "up" if todo.done else "down"
+        (ok, data) = await client.request("POST", "/tasks/" + todo.addons["habitica_id"] + "/score/" + direction)
+        if not ok:
+            failed.add(todo)
+            errors.append(data)
+
+        elif todo.done:
+            completed.add(todo.addons["habitica_id"])
+
+        else:
+            completed.discard(todo.addons["habitica_id"])
+
+    async def upload():
+        jobs = [create_batch(create[i:i + habitica_batch]) for i in range(0, len(create), habitica_batch)]
+        jobs += [update_task(t) for t in update]
+        await asyncio.gather(*jobs)
+        # Scoring a task only works once it has its new text
+        await asyncio.gather(*[score_task(t) for t in score if t not in failed])
+
+    try:
+        asyncio.run(upload())
+    finally:
+        client.close()
+
+    sent = len(create) + len(update) - len(failed)
+    count("tasks synced", sent)
+    count("requests sent", client.requests)
+
+    # Hashes of changed tasks are taken after the ids were added. Tasks that are gone are forgotten.
+    changed = set(changed)
+    synced = set(h for (t, h) in zip(todos, hashes) if t not in changed)
+    synced.update(habitica_hash(t) for t in changed if t not in failed)
+    options["habitica-synced"] = synced
+    options["habitica-completed"] = completed
+    save_options(data_file, options)
 
-                if new_state in ["new", "next", "today", "waiting", "new", "someday"]:
-                    index_list[target].addons["state"] = new_state
-                    out = ("Set state of " + index_list[target].text + " to " + new_state)
+    out = ("Synced " + str(sent) + " tasks with Habitica: " + str(len(create)) + " created, " +
+            str(len(update)) + " updated, " + str(len(score)) + " scored")
+    if errors:
+        out += "\n" + str(len(failed)) + " tasks failed, the first error: " + errors[0]
 
-                elif new_state == "scheduled":
-                    if "due" in index_list[target].addons:
-                        del index_list[target].addons["due"]
+    return (not failed, out)
 
-                    os.system("cal -3")
+def main():
+    global args, data_file, options, snapshot_cache, todo_file, todo_files, local_todos, todo_index, todo_scheduler
+    global todo_lock, todo_externally_changed, todo_history, stats, page
 
-                    while not "due" in index_list[target].addons:
+    args = parser.parse_args()
+    if args.options_file:
+        data_file = args.options_file
+
+    # Clients leave everything to the daemon, nothing is loaded here
+    if args.send:
+        try:
+            failed = send_commands(args.send)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("No daemon running on " + daemon_socket_path() + ", start one with --daemon")
+            sys.exit(1)
+
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.profile or args.stats_out:
+        stats = Stats()
+
+    # Load options
+    if os.path.isfile(data_file):
+        options = load_options(data_file)
+
+    else:
+        options = {}
+
+    # Take option input from user
+    if not "todo.txt-location" in options:
+        options["todo.txt-location"] = input("todo.txt location: ")
+        options["filter-color"] = False
+        # Make sure the file can be written to
+        open(options["todo.txt-location"], "a").close()
+        save_options(data_file, options)
+
+    # The summary is read straight from the files, nothing else needs to be loaded
+    if args.summary:
+        print_summary(workspace_paths())
+        if stats is not None:
+            stats.end_command(args.stats_out)
+            if args.profile:
+                print(stats.report(total = True))
+        return
+
+    # The report is read straight from the files as well, including done.txt
+    if args.report:
+        print_report(workspace_paths())
+        if stats is not None:
+            stats.end_command(args.stats_out)
+            if args.profile:
+                print(stats.report(total = True))
+        return
+
+    # Load todos from todo.txt and the rest of the workspace, or from the snapshot of a file if it hasn't changed
+    snapshot_cache = SnapshotCache(data_file + ".cache")
+    todo_files = [TodoFile(path, journal = options.get("journal", False)) for path in workspace_paths()]
+    todo_file = todo_files[0]
+    loaded = load_todos()
+
+    # Perform automated actions
+    local_todos = TodoList(do_auto_actions(loaded))
+    for origin in todo_files:
+        origin.listeners.append(local_todos)
+    todo_index = TodoIndex(local_todos)
+    todo_scheduler = DueScheduler(local_todos)
+    todo_scheduler.promote()
+
+    if args.daemon:
+        running = run_daemon(loaded)
+        save_snapshots()
+        if not running:
+            sys.exit(1)
+        return
+
+    # Batch mode, tasks are numbered in the order they were read
+    if args.exec:
+        if args.exec == "-":
+            failed = run_batch(sys.stdin, loaded)
+        else:
+            with open(args.exec) as exec_file:
+                failed = run_batch(exec_file, loaded)
+
+        compact_todos()
+        save_snapshots()
+        if stats is not None:
+            stats.end_command(args.stats_out)
+            if args.profile:
+                print(stats.report(total = True))
+
+        if failed:
+            sys.exit(1)
+        return
+
+    next_todos = todo_index.tasks("next")
+    today_todos = todo_index.tasks("today")
+
+    # Everything from here on can be undone, a command or a reviewed task at a time
+    todo_history = History(local_todos, options.get("undo-limit"))
+
+    if args.guided:
+        if len(next_todos) == 0 and not args.summary:
+            if len(today_todos) > 0:
+                if ask_question("No todos marked as next, go through list for today?") == "Y":
+                    for todo in today_todos:
+                        print(todo.human_str())
+                        if ask_question("Mark as next?") == "Y":
+                            set_priority(todo)
+                            todo.addons["state"] = "next"
+                            print("Moved to next")
+
+
+    # Do review
+    if not args.summary and args.guided:
+        for todo in todo_index.tasks("new"):
+            todo_history.commit()
+            if todo.addons["state"] == "new":
+                print("---")
+                print(todo.human_str())
+
+                r = ask_question("Does it take less than 2 minutes?", {"Y": "Yes", "N": "No", "S": "Skip"})
+                if r == "Y":
+                    print("Do it now.")
+                    if ask_question("Is it done?") == "Y":
+                        recur_todo(todo)
+                        todo.done = True
+                        del todo.addons["state"]
+                        print("Task marked as done")
+                        continue
+
+                    else:
+                        continue
+
+                elif r == "S":
+                    break
+
+
+                add_metadata(todo)
+                r = ask_question("Complete (N)ext, (T)oday, at a certain (D)ate or (S)omeday?", 
+                        {"N": "Next", "T": "Today", "D": "Certain date", "S": "Someday"})
+
+                if r == "N":
+                    set_priority(todo)
+                    todo.addons["state"] = "next"
+                    print("Marked as next")
+                    continue
+
+                elif r == "T":
+                    set_priority(todo)
+                    todo.addons["state"] = "today"
+                    print("Marked as today")
+                    continue
+
+                elif r == "D":
+                    while not "due" in todo.addons:
                         try:
-                            index_list[target].addons["due"] = datetime.datetime.strptime(
+                            todo.addons["due"] = datetime.datetime.strptime(
                                     input("Enter date (YYYY-MM-DD): ").strip(), "%Y-%m-%d").date()
                         except ValueError:
                             print("Format not recognized")
+                
+                    todo.addons["state"] = "scheduled"
 
-                    index_list[target].addons["state"] = new_state
-                    out = ("Scheduled " + index_list[target].text + " for " + 
-                            index_list[target].addons["due"].isoformat())
                     continue
 
-                else:
-                    out = "Unrecognized state: " + new_state
+                elif r == "S":
+                    # Delegate to someday
+                    todo.priority = "(Z) "
+                    todo.addons["state"] = "someday"
+                    print("Task marked as \"someday\"")
                     continue
 
+                # TODO: Implement convert to project
+
+    quit = False
+    if not args.summary:
+        # Enter interactive mode
+        out = ""
+        todo_lock = threading.Lock()
+        todo_lock.acquire()
+        for origin in todo_files:
+            threading.Thread(target = watch_todo_changes, args = (FileWatcher(origin.path),), daemon = True).start()
+        threading.Thread(target = promote_at_rollover, daemon = True).start()
+
+        while not quit:
+            # Promote tasks that became due with the last command, which is undone together with the command, then
+            # archive and save tasks. Archived tasks are in done.txt already, so archiving isn't undone.
+            todo_scheduler.promote()
+            todo_history.commit()
+            archive_done_todos(local_todos, todo_index)
+            todo_history.discard()
+            save_todos(local_todos)
+
+            (s, index_list) = get_interactive_task_list(todo_index, filter, page_window())
+            print('\n')
+            print(s)
+
+            if page is not None:
+                pages = max((len(index_list) + get_page_size() - 1) // get_page_size(), 1)
+                page = min(page, pages - 1)
+                print("Page " + str(page + 1) + "/" + str(pages) + " (next, prev, page N, page to show all)")
+
+            if len(filter) != 0:
+                print("Filter: " + ", ".join(filter))
+
+            if out != "":
+                print(out)
+
+            # Everything since the last prompt counts as one command
+            if stats is not None:
+                if args.profile:
+                    print(stats.report())
+                stats.end_command(args.stats_out)
+
+            print("Q to quit")
 
-            elif command == "pri":
+            try:
+                todo_lock.release()
                 try:
-                    new_pri = cmd[2]
+                    inp = input("> ")
+                finally:
+                    todo_lock.acquire()
+
+            except KeyboardInterrupt:
+                quit = True
+                continue
 
-                except IndexError:
-                    out = ("Please specify new priority")
+            # If todo.txt is modified by another program, make sure we have correct task list numbers
+            if todo_externally_changed:
+                (s, index_list) = get_interactive_task_list(todo_index, filter)
+                todo_externally_changed = False
+
+            cmd = inp.split(" ")
+
+            if cmd[0] == "q" or cmd[0] == "Q":
+                quit = True
+
+            elif cmd[0].lower() == "page":
+                if len(cmd) == 1:
+                    if page is None:
+                        page = 0
+                        out = "Paging on"
+                    else:
+                        page = None
+                        out = "Paging off"
                     continue
-                
-                if len(new_pri) == 1 and new_pri.upper() in string.ascii_uppercase:
-                    index_list[target].priority = "(" + new_pri.upper() + ") "
-                    out = "Set priority of " + index_list[target].text + " to " + index_list[target].priority
-                    
-                else:
-                    out = "Please specify a single-letter priority"
 
-            elif command == "done":
-                index_list[target].done = True
-                index_list[target].addons["state"] = "done"
-                index_list[target].completed = datetime.date.today()
-                out = "Marked " + index_list[target].text + " as done."
+                try:
+                    page = max(int(cmd[1]) - 1, 0)
+                    out = ""
+
+                except ValueError:
+                    out = cmd[1] + " is not a valid page number"
+
+            elif cmd[0].lower() == "next" and page is not None:
+                page += 1
+                out = ""
+
+            elif cmd[0].lower() == "prev" and page is not None:
+                page = max(page - 1, 0)
+                out = ""
+
+            elif cmd[0].lower() == "undo":
+                out = "Nothing to undo"
+                if todo_history.undo():
+                    out = "Undone"
 
+            elif cmd[0].lower() == "redo":
+                out = "Nothing to redo"
+                if todo_history.redo():
+                    out = "Redone"
 
             else:
-                out = ("Unknown command: " + cmd[1])
-                continue
+                (ok, out) = run_command(cmd, index_list)
 
 
-# Sort tasks
-local_todos.sort(key = lambda x: str(x))
+    # Don't save if we have been in interactive mode, this reduces chances of overwriting changes made elsewhere
+    if not quit:
+        # Save changes
+        save_todos(local_todos)
 
-# Don't save if we have been in interactive mode, this reduces chances of overwriting changes made elsewhere
-if not quit:
-    # Save changes
-    save_todos(local_todos)
+    # Write the journal into todo.txt, and remember the parsed tasks for the next start
+    compact_todos()
+    save_snapshots()
+
+    if stats is not None:
+        stats.end_command(args.stats_out)
+        if args.profile:
+            print(stats.report(total = True))
+
+if __name__ == "__main__":
+    main()